@@ -0,0 +1,223 @@
+"""
+Benchmarks of the glodap utilities on synthetic data. Run from the
+directory holding the glodap package, e.g.:
+
+    python -m glodap.benchmarks.bench --sizes small medium \\
+        --output results.json --baseline baseline.json
+
+Each benchmark records the best time of a number of runs, the throughput
+in items (rows, profiles, points) per second, and the peak memory
+allocated during one run, traced with tracemalloc. Results are compared
+with the baseline, if it exists, and the exit status is 1 if any
+benchmark is slower or uses more memory than allowed by the tolerance.
+With --save-baseline the results are written as the new baseline.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import datetime
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from ..util.excread import excread
+from ..util.interp import (
+    pchip_interpolate_profile,
+    subst_depth_profile_gaps_with_nans,
+)
+from ..util.stats import stats_and_offset, linear_fit
+from ..util.geo import haversine_distance
+from .synthetic import write_exchange_file
+
+
+# Number of stations for each size
+sizes = {
+    'small': 10,
+    'medium': 100,
+    'large': 1000,
+}
+
+def measure(func, items, repeat=3):
+    """
+    Run func() repeat times and once more under tracemalloc. Returns a dict
+    with the best time in seconds, the throughput in items per second and
+    the peak memory in bytes.
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    best = min(seconds)
+    return {
+        'items': items,
+        'seconds': best,
+        'throughput': items / best if best > 0 else float('inf'),
+        'peak_memory': peak_memory,
+    }
+
+def benchmarks(stations, directory):
+    """
+    Return a dict of name: (func, items) for the benchmarks with the given
+    number of stations, writing the synthetic files to directory
+    """
+    bottle = os.path.join(directory, 'bottle_{}_hy1.csv'.format(stations))
+    bottle_rows = write_exchange_file(bottle, 'BOTTLE', stations)
+    latin1 = os.path.join(directory, 'latin1_{}_hy1.csv'.format(stations))
+    write_exchange_file(latin1, 'BOTTLE', stations, encoding='iso-8859-1')
+    ctd = os.path.join(directory, 'ctd_{}_ct1.csv'.format(stations))
+    ctd_rows = write_exchange_file(ctd, 'CTD', max(stations // 10, 1))
+
+    data = excread(bottle)
+    profiles = [
+        (profile['CTDPRS'].values, profile['SILCAT'].values)
+        for _, profile in data.dropna(subset=['SILCAT']).groupby('STNNBR')
+    ]
+    x_interp = np.arange(0, 6000, 1.0)
+    interpolated = [
+        pchip_interpolate_profile(x, y, x_interp) for x, y in profiles
+    ]
+    frames = [
+        pd.DataFrame({'CTDPRS': x, 'SILCAT': y}).dropna()
+        for x, y in interpolated
+    ]
+    points = stations * 100
+    rng = np.random.RandomState(0)
+    lon = rng.uniform(-180, 180, points)
+    lat = rng.uniform(-90, 90, points)
+
+    def _interpolate():
+        for x, y in profiles:
+            pchip_interpolate_profile(x, y, x_interp)
+
+    def _gaps():
+        for (x, _), (_, y) in zip(profiles, interpolated):
+            subst_depth_profile_gaps_with_nans(x_interp, y, depths=x)
+
+    def _stats():
+        for input, reference in zip(frames, frames[1:]):
+            stats_and_offset(input, reference, 'CTDPRS', 'SILCAT')
+
+    def _haversine():
+        for ix in range(points - 1):
+            haversine_distance(lon[ix], lat[ix], lon[ix + 1], lat[ix + 1])
+
+    return {
+        'excread_bottle': (lambda: excread(bottle), bottle_rows),
+        'excread_latin1': (lambda: excread(latin1), bottle_rows),
+        'excread_ctd': (lambda: excread(ctd), ctd_rows),
+        'pchip_interpolate_profile': (_interpolate, len(profiles)),
+        'subst_depth_profile_gaps_with_nans': (_gaps, len(profiles)),
+        'stats_and_offset': (_stats, max(len(frames) - 1, 0)),
+        'linear_fit': (
+            lambda: linear_fit(data['CTDPRS'].values, data['SILCAT'].values),
+            len(data),
+        ),
+        'haversine_distance': (_haversine, points - 1),
+    }
+
+def run(size_names, repeat=3):
+    """Run the benchmarks for each size, and return the results as a dict"""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in size_names:
+            for name, (func, items) in benchmarks(
+                    sizes[size],
+                    directory,
+            ).items():
+                key = '{}[{}]'.format(name, size)
+                results[key] = measure(func, items, repeat)
+                print(
+                    '{:50} {:>12.4f} s {:>14.1f} items/s {:>12} bytes'.format(
+                        key,
+                        results[key]['seconds'],
+                        results[key]['throughput'],
+                        results[key]['peak_memory'],
+                    )
+                )
+    return {
+        'environment': {
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+        },
+        'results': results,
+    }
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compare results with a baseline. Returns a list of messages for the
+    benchmarks with a throughput below, or a peak memory above, the
+    baseline by more than tolerance (as a fraction).
+    """
+    regressions = []
+    for key, result in results['results'].items():
+        if key not in baseline['results']:
+            continue
+        reference = baseline['results'][key]
+        if result['throughput'] < reference['throughput'] * (1 - tolerance):
+            regressions.append(
+                '{}: throughput {:.1f} items/s, baseline {:.1f}'.format(
+                    key,
+                    result['throughput'],
+                    reference['throughput'],
+                )
+            )
+        if result['peak_memory'] > reference['peak_memory'] * (1 + tolerance):
+            regressions.append(
+                '{}: peak memory {} bytes, baseline {}'.format(
+                    key,
+                    result['peak_memory'],
+                    reference['peak_memory'],
+                )
+            )
+    return regressions
+
+def main(argv=None):
+    arguments = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    arguments.add_argument(
+        '--sizes',
+        nargs='+',
+        choices=list(sizes),
+        default=['small', 'medium'],
+    )
+    arguments.add_argument('--repeat', type=int, default=3)
+    arguments.add_argument('--output', help='write the results to this file')
+    arguments.add_argument('--baseline', help='baseline results file')
+    arguments.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help='write the results as the new baseline',
+    )
+    arguments.add_argument('--tolerance', type=float, default=0.25)
+    options = arguments.parse_args(argv)
+
+    results = run(options.sizes, options.repeat)
+    if options.output:
+        with open(options.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+    if options.baseline and options.save_baseline:
+        with open(options.baseline, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+        return 0
+    if options.baseline and os.path.exists(options.baseline):
+        with open(options.baseline) as infile:
+            regressions = compare(results, json.load(infile), options.tolerance)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+
+
+# Parameters with realistic profile shapes, in the order they are added.
+# Each is (exchange name, unit, surface value, deep value, e-folding depth)
+parameter_profiles = [
+    ('SALNTY', 'PSS-78', 35.5, 34.7, 800),
+    ('OXYGEN', 'UMOL/KG', 250, 180, 1500),
+    ('SILCAT', 'UMOL/KG', 2, 130, 1200),
+    ('NITRAT', 'UMOL/KG', 1, 35, 600),
+    ('NITRIT', 'UMOL/KG', 0.1, 0.01, 200),
+    ('PHSPHT', 'UMOL/KG', 0.1, 2.5, 600),
+    ('TCARBN', 'UMOL/KG', 2000, 2300, 1000),
+    ('ALKALI', 'UMOL/KG', 2300, 2400, 1500),
+    ('CFC-11', 'PMOL/KG', 2.5, 0.01, 500),
+    ('CFC-12', 'PMOL/KG', 1.2, 0.01, 500),
+    ('SF6', 'FMOL/KG', 1.5, 0.01, 400),
+    ('CCL4', 'PMOL/KG', 4, 0.05, 600),
+    ('DOC', 'UMOL/KG', 70, 40, 300),
+    ('TDN', 'UMOL/KG', 6, 40, 800),
+    ('HELIUM', 'NMOL/KG', 1.8, 1.9, 2000),
+    ('NEON', 'NMOL/KG', 7.5, 8, 2000),
+]
+
+# Non-ASCII comment line, exercising the character encoding detection
+comment_line = '# Synthetic data, generated for benchmarking. Ångström, Bjørnøya, Département'
+
+def write_exchange_file(
+        path: str,
+        file_type: str='BOTTLE',
+        stations: int=100,
+        levels: int=None,
+        parameters: int=8,
+        encoding: str='utf-8',
+        missing_fraction: float=0.05,
+        seed: int=0,
+):
+    """
+    Write a synthetic WHP Exchange file, with realistic profiles at
+    stations along a section, and return the number of data rows.
+
+    - file_type: BOTTLE or CTD. Bottle files get SAMPNO and the number of
+      levels defaults to 24, CTD files default to a 2 dbar grid to 6000 dbar
+    - stations: number of stations, one cast each
+    - parameters: number of parameters from parameter_profiles, each with a
+      _FLAG_W column, in addition to CTDPRS, CTDTMP and CTDSAL
+    - encoding: character encoding of the file. The header holds non-ASCII
+      comments, so e.g. iso-8859-1 gives a Latin-1 file
+    - missing_fraction: fraction of parameter values written as -999, with
+      flag 9
+    """
+    rng = np.random.RandomState(seed)
+    if levels is None:
+        levels = 24 if file_type == 'BOTTLE' else 3000
+    bottom = rng.uniform(3000, 6000, stations)
+    pressure = np.linspace(0, 1, levels)[np.newaxis, :] * bottom[:, np.newaxis]
+    if file_type != 'BOTTLE':
+        pressure = np.round(pressure / 2) * 2
+    pressure = np.round(pressure, 1).ravel()
+    station = np.repeat(np.arange(1, stations + 1), levels)
+    rows = len(pressure)
+
+    data = pd.DataFrame({
+        'EXPOCODE': 'SYNTH20261017',
+        'SECT_ID': 'S01',
+        'STNNBR': station,
+        'CASTNO': 1,
+    })
+    if file_type == 'BOTTLE':
+        data['SAMPNO'] = np.tile(np.arange(levels, 0, -1), stations)
+    days = (station - 1) // 10
+    data['DATE'] = (
+        pd.Timestamp('2026-01-01') + pd.to_timedelta(days, unit='D')
+    ).strftime('%Y%m%d')
+    data['TIME'] = [
+        '{:04d}'.format(value) for value in (station * 137) % 2400 // 100 * 100
+    ]
+    data['LATITUDE'] = np.round(-60 + 0.5 * (station - 1) % 120, 4)
+    data['LONGITUDE'] = np.round(-30 + 0.25 * (station - 1) % 60, 4)
+    data['DEPTH'] = np.repeat(np.round(bottom), levels).astype(int)
+    data['CTDPRS'] = pressure
+    data['CTDTMP'] = np.round(
+        20 * np.exp(-pressure / 700) + 1 + rng.normal(0, 0.01, rows),
+        4,
+    )
+    data['CTDSAL'] = np.round(
+        34.7 + 0.8 * np.exp(-pressure / 800) + rng.normal(0, 0.002, rows),
+        4,
+    )
+    units = ['', '', '', '']
+    if file_type == 'BOTTLE':
+        units.append('')
+    units += ['', '', 'DEG N', 'DEG E', 'METERS', 'DBAR', 'ITS-90', 'PSS-78']
+
+    for name, unit, surface, deep, scale in parameter_profiles[:parameters]:
+        values = deep + (surface - deep) * np.exp(-pressure / scale)
+        values = values * (1 + rng.normal(0, 0.01, rows))
+        flags = np.full(rows, 2)
+        missing = rng.uniform(size=rows) < missing_fraction
+        values = np.round(values, 4)
+        values[missing] = -999
+        flags[missing] = 9
+        data[name] = values
+        data[name + '_FLAG_W'] = flags
+        units += [unit, '']
+
+    with open(path, 'w', encoding=encoding, newline='\n') as excfile:
+        excfile.write('{},20261017SYNTH\n'.format(file_type))
+        excfile.write(comment_line + '\n')
+        excfile.write(','.join(data.columns) + '\n')
+        excfile.write(','.join(units) + '\n')
+        data.to_csv(excfile, header=False, index=False)
+        excfile.write('END_DATA\n')
+    return rows
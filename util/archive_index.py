@@ -0,0 +1,311 @@
+import os
+import sqlite3
+import logging
+import pandas as pd
+from .excread import excread_many
+from .exccache import content_hash
+from .data_type_dict import DataTypeDict
+
+
+class ArchiveIndex(object):
+    """
+    Persistent index of an archive of WHP Exchange files, stored in a local
+    SQLite database. For each file, the index holds the file fingerprint,
+    EXPOCODE, time range, lat/lon bounding box, the station/cast list and
+    the parameters in the file, mapped to glodap reference types through
+    DataTypeDict. Usage:
+
+    >>> index = ArchiveIndex('glodap_archive.sqlite')
+    >>> index.update(glob.glob('/data/exchange/*_hy1.csv'))
+    >>> index.query(
+    ...     parameters=['silicate'],
+    ...     bbox=(-30, 50, 0, 70),
+    ...     time_range=('2000-01-01', '2010-12-31'),
+    ... )
+
+    Queries are answered from the database, without opening any exchange
+    file. update() only reads files that are new or have changed since
+    they were last indexed.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            size INTEGER,
+            mtime_ns INTEGER,
+            content_hash TEXT,
+            expocode TEXT,
+            file_type TEXT,
+            signature TEXT,
+            time_min TEXT,
+            time_max TEXT,
+            lat_min REAL,
+            lat_max REAL,
+            lon_min REAL,
+            lon_max REAL
+        );
+        CREATE TABLE IF NOT EXISTS stations (
+            file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+            stnnbr TEXT,
+            castno TEXT,
+            latitude REAL,
+            longitude REAL,
+            time TEXT
+        );
+        CREATE TABLE IF NOT EXISTS parameters (
+            file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+            name TEXT,
+            ref_type TEXT
+        );
+        CREATE INDEX IF NOT EXISTS files_expocode ON files(expocode);
+        CREATE INDEX IF NOT EXISTS stations_file ON stations(file_id);
+        CREATE INDEX IF NOT EXISTS stations_position
+            ON stations(latitude, longitude);
+        CREATE INDEX IF NOT EXISTS parameters_file ON parameters(file_id);
+        CREATE INDEX IF NOT EXISTS parameters_name ON parameters(name);
+        CREATE INDEX IF NOT EXISTS parameters_ref_type
+            ON parameters(ref_type);
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.connection = sqlite3.connect(database)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(self.schema)
+        self.data_types = DataTypeDict()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, paths, workers=None, prune=False):
+        """
+        Index the exchange files in paths. Files already indexed with the
+        same size and modification time, or the same content hash, are not
+        read again. Files which can not be read are logged and skipped,
+        keeping any earlier index entries. If prune is True, files in the
+        index which are not in paths are removed from the index.
+
+        Returns the number of files (re)indexed.
+        """
+        logger = logging.getLogger('glodap.util.archive_index')
+        paths = [os.path.abspath(path) for path in paths]
+        known = {
+            path: (file_id, size, mtime_ns, digest)
+            for file_id, path, size, mtime_ns, digest
+            in self.connection.execute(
+                'SELECT id, path, size, mtime_ns, content_hash FROM files'
+            )
+        }
+
+        changed = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                fingerprint = (stat.st_size, stat.st_mtime_ns)
+                if path in known and known[path][1:3] == fingerprint:
+                    continue
+                digest = content_hash(path)
+            except OSError as err:
+                logger.error('Could not read file {}: {}'.format(path, err))
+                continue
+            if path in known and known[path][3] == digest:
+                # Touched, but not changed
+                with self.connection:
+                    self.connection.execute(
+                        'UPDATE files SET size = ?, mtime_ns = ? WHERE id = ?',
+                        (*fingerprint, known[path][0]),
+                    )
+                continue
+            changed[path] = (*fingerprint, digest)
+
+        with self.connection:
+            if prune:
+                for path in set(known) - set(paths):
+                    self.connection.execute(
+                        'DELETE FROM files WHERE path = ?', (path,)
+                    )
+            for path, dataframe, error in excread_many(
+                    list(changed),
+                    workers=workers,
+                    ordered=False,
+            ):
+                if error is not None:
+                    continue
+                logger.info('Indexing file {}'.format(path))
+                self._insert(path, changed[path], dataframe)
+        return len(changed)
+
+    def _insert(self, path, fingerprint, dataframe):
+        """Replace the index entries for path with data from dataframe"""
+        self.connection.execute('DELETE FROM files WHERE path = ?', (path,))
+        times = dataframe.get('EXC_DATETIME', pd.Series([], dtype=object))
+        cursor = self.connection.execute(
+            """
+            INSERT INTO files (
+                path, size, mtime_ns, content_hash, expocode, file_type,
+                signature, time_min, time_max,
+                lat_min, lat_max, lon_min, lon_max
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                path,
+                *fingerprint,
+                _first(dataframe.get('EXPOCODE')),
+                dataframe.whp_exchange.file_type,
+                dataframe.whp_exchange.signature,
+                _isoformat(times.min()),
+                _isoformat(times.max()),
+                *_range(dataframe.get('LATITUDE')),
+                *_range(dataframe.get('LONGITUDE')),
+            ),
+        )
+        file_id = cursor.lastrowid
+
+        station_keys = [
+            key for key in ('STNNBR', 'CASTNO') if key in dataframe.columns
+        ]
+        if station_keys and {'LATITUDE', 'LONGITUDE'} <= set(dataframe.columns):
+            aggregations = {'LATITUDE': 'mean', 'LONGITUDE': 'mean'}
+            if 'EXC_DATETIME' in dataframe.columns:
+                aggregations['EXC_DATETIME'] = 'min'
+            stations = dataframe.groupby(station_keys).agg(
+                aggregations
+            ).reset_index()
+            self.connection.executemany(
+                """
+                INSERT INTO stations (
+                    file_id, stnnbr, castno, latitude, longitude, time
+                ) VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        file_id,
+                        str(row['STNNBR']) if 'STNNBR' in row else None,
+                        str(row['CASTNO']) if 'CASTNO' in row else None,
+                        _float(row['LATITUDE']),
+                        _float(row['LONGITUDE']),
+                        _isoformat(row.get('EXC_DATETIME')),
+                    )
+                    for _, row in stations.iterrows()
+                ],
+            )
+
+        self.connection.executemany(
+            'INSERT INTO parameters (file_id, name, ref_type) VALUES (?, ?, ?)',
+            [
+                (file_id, name, self._ref_type(name))
+                for name in dataframe.columns
+                if not name.endswith('_FLAG_W')
+                and not name.startswith('EXC_')
+                and dataframe[name].notnull().any()
+            ],
+        )
+
+    def _ref_type(self, name):
+        """Return the name of the glodap reference type for a column"""
+        return self.data_types.reference_type(name)
+
+    def query_stations(self, parameters=None, bbox=None, time_range=None):
+        """
+        Return a pandas DataFrame with the indexed stations matching all of
+        the given criteria:
+
+        - parameters: list of parameters which must all be in the file, as
+          exchange names (e.g. SILCAT) or reference types (e.g. silicate)
+        - bbox: (lon_min, lat_min, lon_max, lat_max). If lon_min > lon_max,
+          the box crosses the date line
+        - time_range: (start, end), as datetimes or ISO formatted strings
+        """
+        conditions = []
+        arguments = []
+        for parameter in parameters or []:
+            conditions.append(
+                """f.id IN (
+                    SELECT file_id FROM parameters
+                    WHERE upper(name) = upper(?) OR ref_type = lower(?)
+                )"""
+            )
+            arguments += [parameter, parameter]
+        if bbox is not None:
+            lon_min, lat_min, lon_max, lat_max = bbox
+            conditions.append('s.latitude BETWEEN ? AND ?')
+            arguments += [lat_min, lat_max]
+            if lon_min <= lon_max:
+                conditions.append('s.longitude BETWEEN ? AND ?')
+            else:
+                conditions.append('(s.longitude >= ? OR s.longitude <= ?)')
+            arguments += [lon_min, lon_max]
+        if time_range is not None:
+            conditions.append('s.time BETWEEN ? AND ?')
+            arguments += [
+                _isoformat(pd.Timestamp(time_range[0])),
+                _isoformat(pd.Timestamp(time_range[1])),
+            ]
+        sql = """
+            SELECT f.expocode, f.path, s.stnnbr, s.castno,
+                s.latitude, s.longitude, s.time
+            FROM stations s JOIN files f ON s.file_id = f.id
+        """
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        return pd.read_sql_query(
+            sql + ' ORDER BY f.expocode, s.stnnbr, s.castno',
+            self.connection,
+            params=arguments,
+        )
+
+    def query(self, parameters=None, bbox=None, time_range=None):
+        """
+        Return a pandas DataFrame with the indexed files having at least one
+        station matching all of the given criteria. See query_stations()
+        for the criteria.
+        """
+        stations = self.query_stations(parameters, bbox, time_range)
+        return pd.read_sql_query(
+            """
+            SELECT expocode, path, file_type, time_min, time_max,
+                lat_min, lat_max, lon_min, lon_max
+            FROM files ORDER BY expocode
+            """,
+            self.connection,
+        ).merge(stations[['path']].drop_duplicates(), on='path')
+
+    def parameters(self, path):
+        """Return the (name, ref_type) of the parameters in an indexed file"""
+        return self.connection.execute(
+            """
+            SELECT p.name, p.ref_type
+            FROM parameters p JOIN files f ON p.file_id = f.id
+            WHERE f.path = ?
+            """,
+            (os.path.abspath(path),),
+        ).fetchall()
+
+
+def _first(series):
+    if series is None or len(series) == 0:
+        return None
+    return str(series.iloc[0])
+
+def _float(value):
+    return None if pd.isnull(value) else float(value)
+
+def _range(series):
+    if series is None:
+        return None, None
+    return _float(series.min()), _float(series.max())
+
+def _isoformat(timestamp):
+    """Format a timestamp as a sortable UTC ISO string for SQLite"""
+    if timestamp is None or pd.isnull(timestamp):
+        return None
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S')
@@ -0,0 +1,475 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import concurrent.futures
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, the reference data is copied to each worker instead
+    shared_memory = None
+import pandas as pd
+import numpy as np
+from .excread import excread
+from .interp import (
+    remove_nans,
+    average_values_for_duplicate_dimension,
+    pchip_interpolate_profile,
+    subst_depth_profile_gaps_with_nans,
+    get_regular_grid,
+    PchipCache,
+)
+from .stats import stats_and_offset
+from .station_index import StationIndex
+
+
+def crossover_analysis(
+        cruise: str or pd.DataFrame,
+        reference: pd.DataFrame,
+        dependent_keys: str or list,
+        dimension_key: str='CTDPRS',
+        grid_dimension: str='pressure',
+        step: float=10,
+        max_distance: float=200000,
+        use_additive_offset: bool=False,
+        station_keys: list=['EXPOCODE', 'STNNBR', 'CASTNO'],
+        workers: int=None,
+        checkpoint_dir: str=None,
+):
+    """
+    Run a crossover analysis of a cruise against reference data:
+
+    - read the cruise, if cruise is the path to an exchange file
+    - find all reference stations within max_distance meters of each
+      station of the cruise, using a StationIndex
+    - for each pair of stations and each dependent key, remove NaNs,
+      average duplicate dimension values, interpolate both profiles with
+      pchip_interpolate_profile() on their common range of the canonical
+      grid for step and grid_dimension, and set gaps to NaN with
+      subst_depth_profile_gaps_with_nans()
+    - calculate stats and offsets with stats_and_offset()
+
+    Reference stations from the same EXPOCODE as the cruise are left out.
+    The station pairs are processed on a pool of workers processes. On
+    Python 3.8 or later, the reference data is shared with the workers
+    through read-only shared memory instead of being copied to each of them.
+
+    If checkpoint_dir is given, the results for each cruise station are
+    saved there as they complete, and stations already saved are skipped.
+    An interrupted run is resumed by running it again with the same
+    checkpoint_dir. The directory holds a manifest with a fingerprint of
+    the options and of the cruise and reference data, and resuming with
+    other options or data raises an Exception instead of returning stale
+    results.
+
+    Returns a pandas.DataFrame with one row per station pair and dependent
+    key, with the following columns:
+
+    columns = [*station_keys, *['REF_' + key for key in station_keys],
+    'distance', 'parameter', 'count', 'station1_mean', 'station1_stdev',
+    'station2_mean', 'station2_stdev', 'offset_mean', 'offset_stdev',
+    ]
+    """
+    logger = logging.getLogger('glodap.util.crossover')
+    if isinstance(dependent_keys, str):
+        dependent_keys = [ dependent_keys ]
+    if isinstance(cruise, str):
+        cruise = excread(cruise)
+    columns = [dimension_key] + dependent_keys
+    options = {
+        'dimension_key': dimension_key,
+        'dependent_keys': dependent_keys,
+        'grid_dimension': grid_dimension,
+        'step': step,
+        'use_additive_offset': use_additive_offset,
+    }
+
+    cruise_stations, cruise_values, cruise_offsets = _pack_stations(
+        cruise,
+        station_keys,
+        columns,
+    )
+    ref_stations, ref_values, ref_offsets = _pack_stations(
+        reference,
+        station_keys,
+        columns,
+    )
+
+    # Find nearby reference stations
+    index = StationIndex(
+        ref_stations['LONGITUDE'].values,
+        ref_stations['LATITUDE'].values,
+    )
+    station, ref_station, distance = index.stations_within_distance(
+        cruise_stations['LONGITUDE'].values,
+        cruise_stations['LATITUDE'].values,
+        max_distance,
+    )
+    if 'EXPOCODE' in station_keys:
+        other_cruise = (
+            cruise_stations['EXPOCODE'].values[station]
+            != ref_stations['EXPOCODE'].values[ref_station]
+        )
+        station = station[other_cruise]
+        ref_station = ref_station[other_cruise]
+        distance = distance[other_cruise]
+
+    tasks = {}
+    for ix in np.unique(station):
+        in_station = station == ix
+        tasks[ix] = (ref_station[in_station], distance[in_station])
+
+    # Resume from checkpoints
+    results = []
+    if checkpoint_dir is not None:
+        _check_manifest(
+            checkpoint_dir,
+            _run_fingerprint(
+                dict(
+                    options,
+                    max_distance=max_distance,
+                    station_keys=station_keys,
+                ),
+                (cruise_stations, cruise_values, cruise_offsets),
+                (ref_stations, ref_values, ref_offsets),
+            ),
+        )
+        for ix in list(tasks):
+            path = _checkpoint_path(checkpoint_dir, cruise_stations, ix)
+            if os.path.exists(path):
+                results.append(pd.read_csv(path))
+                del tasks[ix]
+    logger.info(
+        'Comparing {} station pairs for {} stations'.format(
+            sum(len(task[0]) for task in tasks.values()),
+            len(tasks),
+        )
+    )
+
+    for ix, records in _run_tasks(
+            tasks,
+            (cruise_values, cruise_offsets, ref_values, ref_offsets, options),
+            workers,
+    ):
+        output = _station_results(
+            records,
+            station_keys,
+            cruise_stations.iloc[ix],
+            ref_stations,
+        )
+        if checkpoint_dir is not None:
+            path = _checkpoint_path(checkpoint_dir, cruise_stations, ix)
+            output.to_csv(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+        results.append(output)
+
+    if not results:
+        return _station_results([], station_keys, None, ref_stations)
+    return pd.concat(results, ignore_index=True, sort=False)
+
+def compare_profiles(
+        input: pd.DataFrame,
+        reference: pd.DataFrame,
+        dimension_key: str,
+        dependent_key: str,
+        grid_dimension: str='pressure',
+        step: float=10,
+        use_additive_offset: bool=False,
+        cache: PchipCache=None,
+        profile_ids: tuple=(None, None),
+):
+    """
+    Compare the dependent_key profiles of two stations, see
+    crossover_analysis(). Returns a dict with count, station1_mean,
+    station1_stdev, station2_mean, station2_stdev, offset_mean and
+    offset_stdev, or None if the profiles can not be compared.
+
+    If a PchipCache is given as cache, the fitted profiles are taken from
+    it, keyed by profile_ids for input and reference, so a station compared
+    with many others is only fitted once.
+    """
+    profiles = []
+    for data in (input, reference):
+        data = remove_nans(data[[dimension_key, dependent_key]],
+            [dimension_key, dependent_key])
+        if len(data) < 2:
+            return None
+        profiles.append(
+            average_values_for_duplicate_dimension(data, dimension_key)
+        )
+
+    _min = max(profile[dimension_key].min() for profile in profiles)
+    _max = min(profile[dimension_key].max() for profile in profiles)
+    if _min >= _max:
+        return None
+    x_interp, _ = get_regular_grid(_min, _max, step, grid_dimension)
+    if len(x_interp) < 2:
+        return None
+
+    interpolated = []
+    for profile, profile_id in zip(profiles, profile_ids):
+        x = profile[dimension_key].values
+        _, y_interp = pchip_interpolate_profile(
+            x,
+            profile[dependent_key].values,
+            x_interp,
+            cache=cache,
+            profile_id=profile_id,
+        )
+        _, y_interp = subst_depth_profile_gaps_with_nans(
+            x_interp,
+            y_interp,
+            depths=x,
+        )
+        interpolated.append(
+            remove_nans(
+                pd.DataFrame({dimension_key: x_interp, dependent_key: y_interp}),
+                dependent_key,
+            )
+        )
+
+    output = stats_and_offset(
+        interpolated[0],
+        interpolated[1],
+        dimension_key,
+        dependent_key,
+        use_additive_offset,
+    )
+    if len(output) < 2:
+        return None
+    # Stats of the reference station on the same dimension values
+    reference_output = stats_and_offset(
+        interpolated[1],
+        interpolated[0],
+        dimension_key,
+        dependent_key,
+        use_additive_offset,
+    )
+    return {
+        'count': len(output),
+        'station1_mean': output[dependent_key + '_mean'].iloc[0],
+        'station1_stdev': output[dependent_key + '_stdev'].iloc[0],
+        'station2_mean': reference_output[dependent_key + '_mean'].iloc[0],
+        'station2_stdev': reference_output[dependent_key + '_stdev'].iloc[0],
+        'offset_mean': output['offset'].mean(),
+        'offset_stdev': output['offset'].std(),
+    }
+
+def _pack_stations(data, station_keys, columns):
+    """
+    Sort the rows of data by station, and return a tuple (stations, values,
+    offsets): a DataFrame with station_keys, LONGITUDE and LATITUDE for each
+    station, a float array with the given columns for all rows, and the row
+    offsets of each station in values.
+    """
+    groups = data.groupby(station_keys)
+    station = groups.ngroup().values
+    in_station = station >= 0
+    order = np.argsort(station[in_station], kind='mergesort')
+    values = np.ascontiguousarray(
+        data[columns].values[in_station][order],
+        dtype=float,
+    )
+    counts = np.bincount(station[in_station], minlength=groups.ngroups)
+    offsets = np.r_[0, np.cumsum(counts)]
+    stations = groups[['LONGITUDE', 'LATITUDE']].first().reset_index()
+    return stations, values, offsets
+
+def _run_fingerprint(options, *packed):
+    """
+    Return a hash of the options and of the packed (stations, values,
+    offsets) data of a crossover analysis
+    """
+    digest = hashlib.sha1(
+        json.dumps(options, sort_keys=True, default=str).encode('utf-8')
+    )
+    for stations, values, offsets in packed:
+        digest.update(pd.util.hash_pandas_object(stations).values.tobytes())
+        digest.update(np.ascontiguousarray(values).tobytes())
+        digest.update(np.ascontiguousarray(offsets).tobytes())
+    return digest.hexdigest()
+
+def _check_manifest(checkpoint_dir, fingerprint):
+    """
+    Create checkpoint_dir with a manifest holding fingerprint, or check that
+    the existing manifest holds the same fingerprint
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = os.path.join(checkpoint_dir, 'manifest.json')
+    try:
+        with open(path) as jsonfile:
+            manifest = json.load(jsonfile)
+    except FileNotFoundError:
+        with open(path + '.tmp', 'w') as jsonfile:
+            json.dump({'fingerprint': fingerprint}, jsonfile)
+        os.replace(path + '.tmp', path)
+        return
+    if manifest.get('fingerprint') != fingerprint:
+        raise Exception(
+            'Checkpoints in {} are from a run with other options or data, '
+            'use another checkpoint_dir'.format(checkpoint_dir)
+        )
+
+def _checkpoint_path(checkpoint_dir, stations, ix):
+    name = '_'.join(
+        str(value) for value in stations.drop(
+            columns=['LONGITUDE', 'LATITUDE']
+        ).iloc[ix]
+    )
+    return os.path.join(
+        checkpoint_dir,
+        re.sub('[^A-Za-z0-9_.-]', '-', name) + '.csv',
+    )
+
+def _station_results(records, station_keys, station, ref_stations):
+    """Build the output DataFrame for one cruise station"""
+    columns = [
+        *station_keys,
+        *['REF_' + key for key in station_keys],
+        'distance', 'parameter', 'count',
+        'station1_mean', 'station1_stdev', 'station2_mean', 'station2_stdev',
+        'offset_mean', 'offset_stdev',
+    ]
+    if not records:
+        return pd.DataFrame(columns=columns)
+    output = pd.DataFrame(records)
+    for key in station_keys:
+        output[key] = station[key]
+        output['REF_' + key] = ref_stations[key].values[
+            output['reference_station'].values
+        ]
+    return output[columns]
+
+# Data of the current worker process, set by _init_worker()
+_worker_data = {}
+
+def _init_worker(
+        cruise_values,
+        cruise_offsets,
+        ref_values,
+        ref_offsets,
+        options,
+        shared_name=None,
+):
+    """
+    Set up the data for a worker process. If shared_name is given,
+    ref_values is a (shape, dtype) tuple describing the reference values in
+    the shared memory block with that name.
+    """
+    if shared_name is not None:
+        # The block is owned and unlinked by the parent process
+        shared = shared_memory.SharedMemory(name=shared_name)
+        shape, dtype = ref_values
+        ref_values = np.ndarray(shape, dtype=dtype, buffer=shared.buf)
+        _worker_data['shared'] = shared
+    ref_values.setflags(write=False)
+    _worker_data.update(
+        cruise_values=cruise_values,
+        cruise_offsets=cruise_offsets,
+        ref_values=ref_values,
+        ref_offsets=ref_offsets,
+        options=options,
+        cache=PchipCache(),
+    )
+
+def _crossover_task(station, ref_stations, distances):
+    """
+    Compare one cruise station with its nearby reference stations, in a
+    worker process. Returns a list of records.
+    """
+    options = _worker_data['options']
+    columns = [options['dimension_key']] + options['dependent_keys']
+
+    def _station_frame(values, offsets, ix):
+        return pd.DataFrame(
+            values[offsets[ix]:offsets[ix + 1]],
+            columns=columns,
+        )
+
+    input = _station_frame(
+        _worker_data['cruise_values'],
+        _worker_data['cruise_offsets'],
+        station,
+    )
+    records = []
+    for ref_station, distance in zip(ref_stations, distances):
+        reference = _station_frame(
+            _worker_data['ref_values'],
+            _worker_data['ref_offsets'],
+            ref_station,
+        )
+        for key in options['dependent_keys']:
+            record = compare_profiles(
+                input,
+                reference,
+                options['dimension_key'],
+                key,
+                options['grid_dimension'],
+                options['step'],
+                options['use_additive_offset'],
+                _worker_data['cache'],
+                (('cruise', station, key), ('reference', ref_station, key)),
+            )
+            if record is None:
+                continue
+            record.update(
+                reference_station=ref_station,
+                distance=distance,
+                parameter=key,
+            )
+            records.append(record)
+    return records
+
+def _run_tasks(tasks, data, workers=None):
+    """
+    Run _crossover_task() for each station in tasks, on a process pool
+    sharing the reference values if shared_memory is available. Generates
+    (station, records) tuples as the tasks complete.
+    """
+    cruise_values, cruise_offsets, ref_values, ref_offsets, options = data
+    if not tasks:
+        return
+    if workers == 1:
+        _init_worker(*data)
+        for station, task in tasks.items():
+            yield station, _crossover_task(station, *task)
+        return
+
+    initargs = data
+    shared = None
+    if shared_memory is not None:
+        shared = shared_memory.SharedMemory(
+            create=True,
+            size=max(ref_values.nbytes, 1),
+        )
+    try:
+        if shared is not None:
+            np.ndarray(
+                ref_values.shape,
+                dtype=ref_values.dtype,
+                buffer=shared.buf,
+            )[:] = ref_values
+            initargs = (
+                cruise_values,
+                cruise_offsets,
+                (ref_values.shape, ref_values.dtype),
+                ref_offsets,
+                options,
+                shared.name,
+            )
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=initargs,
+        ) as pool:
+            futures = {
+                pool.submit(_crossover_task, station, *task): station
+                for station, task in tasks.items()
+            }
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+    finally:
+        if shared is not None:
+            shared.close()
+            shared.unlink()
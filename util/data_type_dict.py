@@ -1,13 +1,19 @@
+import collections
+from types import MappingProxyType
+import pandas as pd
+
+
 class DataType:
     """
     DataType simply has a name and a BODC identifier. It can be linked to
     a parent data type, which would be the datatype from the glodap data set.
     Glodap data types has is_ref_type = True, and should not have parent types.
+
+    DataTypes are immutable, since the same objects are shared by all
+    DataTypeDict instances.
     """
-    name = None
-    identifier = None
-    parent_ref_type = None
-    is_ref_type = False
+    __slots__ = ('name', 'identifier', 'parent_ref_type', 'is_ref_type')
+
     def __init__(
             self,
             name,
@@ -15,13 +21,22 @@ class DataType:
             parent_ref_type = None,
             is_ref_type = False,
     ):
-        self.name = name
-        self.identifier = identifier
-        self.parent_ref_type = parent_ref_type
-        self.is_ref_type = is_ref_type
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'identifier', identifier)
+        object.__setattr__(self, 'parent_ref_type', parent_ref_type)
+        object.__setattr__(self, 'is_ref_type', is_ref_type)
 
-    def set_parent_reference_type(self, parent_ref_type):
-        self.parent_ref_type = parent_ref_type
+    def __setattr__(self, name, value):
+        raise AttributeError('DataType {} is read-only'.format(self.name))
+
+    def __delattr__(self, name):
+        raise AttributeError('DataType {} is read-only'.format(self.name))
+
+    def __reduce__(self):
+        return (
+            DataType,
+            (self.name, self.identifier, self.parent_ref_type, self.is_ref_type),
+        )
 
     def __str__(self):
         return self.name
@@ -148,35 +163,92 @@ class DataTypeDict():
         'TRITUM'       : 'SDN:P01::ACTVM012',
     }
 
-    typelist = {}
-
-
-
     def __init__(self):
-        for name in self.reference_types:
-            self.typelist[name] = DataType(
-                name,
-                is_ref_type = True,
-                identifier = self.reference_types[name]
-            )
-        for name in self.exchange_types:
-            self.typelist[name] = DataType(
-                name,
-                parent_ref_type = self.typelist.get(
-                    self.get_ref_type(self.exchange_types[name])
-                ),
-                identifier = self.exchange_types[name],
-            )
+        # Per instance, so adding types to one instance leaves others alone
+        self.typelist = dict(_lookup_tables().typelist)
 
     def getIdentifier(self, var_name):
         return self.typelist.get(var_name).identifier
 
     def get_ref_type(self, identifier):
-        for k,v in self.reference_types.items():
-            if v == identifier:
-                return k
+        """Return the name of the reference type with identifier, or None"""
+        return _lookup_tables().ref_types.get(identifier)
+
+    def get_exchange_names(self, identifier):
+        """Return a tuple of the exchange names with identifier"""
+        return _lookup_tables().exchange_names.get(identifier, ())
+
+    def reference_type(self, name):
+        """
+        Return the name of the reference type for an exchange name or a
+        reference type name, or None.
+
+        >>> DataTypeDict().reference_type('SILCAT')
+        'silicate'
+        """
+        data_type = self.typelist.get(name)
+        if data_type is None:
+            return None
+        if data_type.is_ref_type:
+            return data_type.name
+        if data_type.parent_ref_type is not None:
+            return data_type.parent_ref_type.name
         return None
 
+    def map_columns(self, dataframe, rename: bool=False):
+        """
+        Map all columns of an exchange DataFrame to reference types at once.
+        Flag columns (e.g. SILCAT_FLAG_W) map with their parameter.
+
+        If rename is False, return a pandas.DataFrame indexed by column name,
+        with columns parameter, identifier, ref_type and is_flag, NaN where a
+        column has no mapping.
+
+        If rename is True, return a copy of dataframe with the columns
+        renamed to their reference types, e.g. SILCAT to silicate and
+        SILCAT_FLAG_W to silicate_FLAG_W. Columns without a reference type,
+        or with a reference type already used by an earlier column (e.g.
+        SALNTY after CTDSAL) or by a column name, keep their names.
+        """
+        columns = pd.Index(dataframe.columns).astype(str)
+        is_flag = columns.str.endswith('_FLAG_W')
+        parameters = columns.where(~is_flag, columns.str[:-len('_FLAG_W')])
+        ref_types = parameters.map(self.reference_type)
+        if not rename:
+            return pd.DataFrame(
+                {
+                    'parameter': parameters,
+                    'identifier': parameters.map(
+                        lambda name: getattr(
+                            self.typelist.get(name), 'identifier', None
+                        )
+                    ),
+                    'ref_type': ref_types,
+                    'is_flag': is_flag,
+                },
+                index=columns,
+                columns=['parameter', 'identifier', 'ref_type', 'is_flag'],
+            )
+
+        renamed = {}
+        taken = set(columns)
+        for parameter, ref_type in zip(
+                parameters[~is_flag],
+                ref_types[~is_flag],
+        ):
+            if ref_type is None or ref_type in taken:
+                continue
+            renamed[parameter] = ref_type
+            taken.add(ref_type)
+        names = [
+            renamed[parameter] + ('_FLAG_W' if flag else '')
+            if parameter in renamed else column
+            for column, parameter, flag in zip(columns, parameters, is_flag)
+        ]
+        output = dataframe.copy()
+        output.columns = names
+        return output
+
     def __iter__(self):
         return iter(self.typelist)
 
@@ -188,3 +260,53 @@ class DataTypeDict():
 
     def items(self):
         return self.typelist.items()
+
+
+_LookupTables = collections.namedtuple(
+    '_LookupTables',
+    ['typelist', 'ref_types', 'exchange_names'],
+)
+
+# Built on first use by _lookup_tables()
+_tables = None
+
+def _lookup_tables():
+    """
+    Return the read-only lookup tables of DataTypeDict, building them the
+    first time:
+
+    - typelist: name -> DataType, for reference and exchange types
+    - ref_types: identifier -> name of the first reference type with it
+    - exchange_names: identifier -> tuple of exchange names with it
+    """
+    global _tables
+    if _tables is not None:
+        return _tables
+    ref_types = {}
+    for name, identifier in DataTypeDict.reference_types.items():
+        ref_types.setdefault(identifier, name)
+    exchange_names = {}
+    for name, identifier in DataTypeDict.exchange_types.items():
+        exchange_names.setdefault(identifier, []).append(name)
+
+    typelist = {}
+    for name, identifier in DataTypeDict.reference_types.items():
+        typelist[name] = DataType(
+            name,
+            is_ref_type = True,
+            identifier = identifier,
+        )
+    for name, identifier in DataTypeDict.exchange_types.items():
+        typelist[name] = DataType(
+            name,
+            parent_ref_type = typelist.get(ref_types.get(identifier)),
+            identifier = identifier,
+        )
+    _tables = _LookupTables(
+        MappingProxyType(typelist),
+        MappingProxyType(ref_types),
+        MappingProxyType(
+            {key: tuple(names) for key, names in exchange_names.items()}
+        ),
+    )
+    return _tables
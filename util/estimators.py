@@ -0,0 +1,208 @@
+import pandas as pd
+import numpy as np
+from .stats import linear_fit
+
+
+def offset_weights(
+        stdev,
+        depth_range=None,
+        min_stdev: float=1e-6,
+):
+    """
+    Return weights for crossover offsets: the inverse variance of each
+    offset, 1/stdev**2, multiplied by the depth range covered by the
+    crossover, if given. Offsets from noisy or short crossovers thereby
+    count less. stdev is floored at min_stdev, so a perfect match does not
+    get an infinite weight. NaN stdevs or depth ranges give zero weight.
+
+    >>> offset_weights([0.5, 1.0, np.nan], depth_range=[1000, 2000, 3000])
+    array([4000., 2000.,    0.])
+    """
+    stdev = np.maximum(np.asarray(stdev, dtype=float), min_stdev)
+    weights = 1 / stdev**2
+    if depth_range is not None:
+        weights = weights * np.asarray(depth_range, dtype=float)
+    weights[np.isnan(weights)] = 0
+    return weights
+
+def weighted_mean(values, weights=None):
+    """
+    Return a tuple (mean, stdev) of the weighted mean and the weighted
+    standard deviation of values, ignoring NaN values.
+
+    >>> weighted_mean([1.0, 2.0, np.nan], [3, 1, 1])
+    (1.25, 0.4330127018922193)
+    """
+    values, weights = _valid_values(values, weights)
+    if weights.sum() <= 0:
+        return np.nan, np.nan
+    mean = np.average(values, weights=weights)
+    stdev = np.sqrt(np.average((values - mean)**2, weights=weights))
+    return mean, stdev
+
+def weighted_linear_fit(x, y, weights=None):
+    """
+    Same as stats.linear_fit(), with each point weighted by weights (e.g.
+    from offset_weights()). Points where x, y or the weight are NaN are
+    removed first.
+
+    Return a tuple (slope, intercept)
+    """
+    if weights is None:
+        return linear_fit(x, y)
+    x, y, weights = _valid_values(x, y, weights)
+    # polyfit weights the residuals, not their squares
+    return np.polyfit(x, y, 1, w=np.sqrt(weights))
+
+def bootstrap_weighted_mean(
+        values,
+        weights=None,
+        nboot: int=1000,
+        confidence: float=0.95,
+        seed=None,
+):
+    """
+    Bootstrap the weighted mean of values. All nboot resamples are drawn
+    as one (nboot, len(values)) matrix of indices, and their means
+    calculated in a single vectorized operation.
+
+    Returns a tuple (mean, ci_low, ci_high), with the percentile confidence
+    interval at the given confidence level.
+    """
+    values, weights = _valid_values(values, weights)
+    mean, _ = weighted_mean(values, weights)
+    if len(values) < 2:
+        return mean, np.nan, np.nan
+    sample = _resample(len(values), nboot, seed)
+    sample_weights = weights[sample]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (
+            (values[sample] * sample_weights).sum(axis=1)
+            / sample_weights.sum(axis=1)
+        )
+    return (mean, *_percentile_interval(means, confidence))
+
+def bootstrap_linear_fit(
+        x,
+        y,
+        weights=None,
+        nboot: int=1000,
+        confidence: float=0.95,
+        seed=None,
+):
+    """
+    Bootstrap weighted_linear_fit(x, y, weights). The least squares fits of
+    all nboot resamples of the points are solved at once, from weighted
+    sums over a (nboot, len(x)) matrix of indices.
+
+    Returns a tuple ((slope, ci_low, ci_high), (intercept, ci_low, ci_high))
+    """
+    x, y, weights = _valid_values(x, y, weights)
+    slope, intercept = weighted_linear_fit(x, y, weights)
+    if len(x) < 3:
+        return (slope, np.nan, np.nan), (intercept, np.nan, np.nan)
+    sample = _resample(len(x), nboot, seed)
+    w = weights[sample]
+    xs = x[sample]
+    ys = y[sample]
+    sw = w.sum(axis=1)
+    swx = (w * xs).sum(axis=1)
+    swy = (w * ys).sum(axis=1)
+    swxx = (w * xs * xs).sum(axis=1)
+    swxy = (w * xs * ys).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slopes = (sw * swxy - swx * swy) / (sw * swxx - swx**2)
+        intercepts = (swy - slopes * swx) / sw
+    return (
+        (slope, *_percentile_interval(slopes, confidence)),
+        (intercept, *_percentile_interval(intercepts, confidence)),
+    )
+
+def weighted_mean_offset(
+        crossovers: pd.DataFrame,
+        group_keys: str or list='parameter',
+        offset_key: str='offset_mean',
+        stdev_key: str='offset_stdev',
+        depth_range_key: str=None,
+        nboot: int=1000,
+        confidence: float=0.95,
+        seed=None,
+):
+    """
+    Summarize crossover offsets, e.g. from crossover.crossover_analysis()
+    or stats.stats_and_offset_batch(), into one weighted mean offset per
+    group (by default per parameter). The offsets are weighted with
+    offset_weights() on stdev_key and, if given, depth_range_key.
+
+    Returns a pandas.DataFrame with one row per group, and the following
+    columns:
+
+    columns = [*group_keys, 'count', 'offset', 'offset_stdev', 'ci_low',
+    'ci_high',
+    ]
+    """
+    if isinstance(group_keys, str):
+        group_keys = [ group_keys ]
+    weights = offset_weights(
+        crossovers[stdev_key].values,
+        crossovers[depth_range_key].values if depth_range_key else None,
+    )
+    rng = _random_state(seed)
+    rows = []
+    for group, ix in crossovers.groupby(group_keys).indices.items():
+        if len(group_keys) == 1:
+            group = (group,)
+        values = crossovers[offset_key].values[ix]
+        offset, ci_low, ci_high = bootstrap_weighted_mean(
+            values,
+            weights[ix],
+            nboot,
+            confidence,
+            rng,
+        )
+        rows.append((
+            *group,
+            np.count_nonzero(pd.notnull(values) & (weights[ix] > 0)),
+            offset,
+            weighted_mean(values, weights[ix])[1],
+            ci_low,
+            ci_high,
+        ))
+    return pd.DataFrame(
+        rows,
+        columns=[
+            *group_keys, 'count', 'offset', 'offset_stdev', 'ci_low',
+            'ci_high',
+        ],
+    )
+
+def _valid_values(*arrays):
+    """
+    Return the arrays as floats, without positions where any of them is
+    NaN. The last array holds weights, and defaults to ones if None.
+    """
+    if arrays[-1] is None:
+        arrays = (*arrays[:-1], np.ones(len(arrays[0])))
+    arrays = [np.asarray(array, dtype=float) for array in arrays]
+    valid = np.ones(len(arrays[0]), dtype=bool)
+    for array in arrays:
+        valid &= ~np.isnan(array)
+    return tuple(array[valid] for array in arrays)
+
+def _random_state(seed):
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+def _resample(n, nboot, seed):
+    """Return an (nboot, n) matrix of bootstrap indices into n values"""
+    return _random_state(seed).randint(0, n, size=(nboot, n))
+
+def _percentile_interval(estimates, confidence):
+    """Return the (low, high) percentile interval of bootstrap estimates"""
+    estimates = estimates[np.isfinite(estimates)]
+    if len(estimates) == 0:
+        return np.nan, np.nan
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(estimates, [tail, 100 - tail])
+    return low, high
@@ -0,0 +1,275 @@
+import os
+import io
+import json
+import hashlib
+import logging
+import zipfile
+import tempfile
+import pandas as pd
+import numpy as np
+from .excread import (
+    excread,
+    _get_exchange_metadata,
+    _set_exchange_metadata,
+    _reader_version,
+)
+
+
+class ExchangeCache(object):
+    """
+    Persistent on-disk cache of parsed WHP Exchange files. Each cached file
+    is stored column by column in an uncompressed numpy .npz archive, next
+    to a small json file holding the column layout and the whp_exchange
+    metadata. Usage:
+
+    >>> cache = ExchangeCache('/tmp/glodap-cache', max_size=2 * 1024**3)
+    >>> dataframe = cache.excread('33RR20160208_hy1.csv')
+
+    Entries are keyed by the absolute path, size, modification time and a
+    hash of the content of the file, together with the read options and
+    the versions of excread() and of the cache format. When
+    the total size of the cache exceeds max_size (bytes), the least
+    recently used entries are removed.
+    """
+    hash_block_size = 1024 * 1024
+    # Version of the layout of cache entries, bump it when _store() changes
+    format_version = 1
+
+    def __init__(self, directory, max_size=2 * 1024**3):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def excread(self, path, **kwargs):
+        """
+        Return the data frame for the exchange file at path from the cache,
+        reading and caching it with excread(path, **kwargs) on a miss.
+        """
+        key = self.key(path, **kwargs)
+        dataframe = self._load(key)
+        if dataframe is not None:
+            self.hits += 1
+            return dataframe
+        self.misses += 1
+        dataframe = excread(path, **kwargs)
+        if dataframe is None:
+            # Skipped by excread(), e.g. for missing params
+            return None
+        self._store(key, dataframe)
+        self._evict()
+        return dataframe
+
+    def key(self, path, **kwargs):
+        """Return the cache key for the file at path and read options"""
+        stat = os.stat(path)
+        fingerprint = json.dumps(
+            [
+                os.path.abspath(path),
+                stat.st_size,
+                stat.st_mtime_ns,
+                content_hash(path, self.hash_block_size),
+                sorted((k, repr(v)) for k, v in kwargs.items()),
+                _reader_version,
+                self.format_version,
+            ]
+        )
+        return hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+
+    def size(self):
+        """Return the total size of the cache in bytes"""
+        return sum(size for _, size, _ in self._entries())
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        for key, _, _ in self._entries():
+            self._remove(key)
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def _entries(self):
+        """Return a list of (key, size, last_used) for all entries"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz'):
+                continue
+            key = name[:-len('.npz')]
+            try:
+                stat = os.stat(self._path(key, '.npz'))
+                size = stat.st_size + os.path.getsize(self._path(key, '.json'))
+            except OSError:
+                continue
+            entries.append((key, size, stat.st_mtime))
+        return entries
+
+    def _remove(self, key):
+        for extension in ('.json', '.npz'):
+            try:
+                os.remove(self._path(key, extension))
+            except OSError:
+                pass
+
+    def _evict(self):
+        """Remove least recently used entries until within max_size"""
+        logger = logging.getLogger('glodap.util.exccache')
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.max_size:
+                break
+            logger.debug('Evicting cache entry {}'.format(key))
+            self._remove(key)
+            total -= size
+
+    def _store(self, key, dataframe):
+        """Write dataframe to the cache, one array per column"""
+        arrays = {'index': np.asarray(dataframe.index)}
+        columns = []
+        for ix, name in enumerate(dataframe.columns):
+            column, column_arrays = _encode_column(ix, dataframe[name])
+            column['name'] = name
+            columns.append(column)
+            arrays.update(column_arrays)
+        layout = {
+            'columns': columns,
+            'metadata': _get_exchange_metadata(dataframe),
+        }
+
+        # Write to temporary files first, so readers never see partial
+        # entries. Each writer gets its own, so concurrent writers of the
+        # same entry do not clobber each other's files
+        npz_path = self._write_temporary(
+            key,
+            'wb',
+            lambda npzfile: np.savez(npzfile, **arrays),
+        )
+        try:
+            json_path = self._write_temporary(
+                key,
+                'w',
+                lambda jsonfile: json.dump(layout, jsonfile),
+            )
+        except BaseException:
+            os.remove(npz_path)
+            raise
+        os.replace(json_path, self._path(key, '.json'))
+        os.replace(npz_path, self._path(key, '.npz'))
+
+    def _write_temporary(self, key, mode, write):
+        """
+        Call write(file) on a new temporary file in the cache directory, and
+        return its path
+        """
+        fd, path = tempfile.mkstemp(
+            dir=self.directory,
+            prefix=key + '.',
+            suffix='.tmp',
+        )
+        try:
+            with os.fdopen(fd, mode) as tmpfile:
+                write(tmpfile)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path
+
+    def _load(self, key):
+        """Read the entry for key from the cache, or return None"""
+        try:
+            with open(self._path(key, '.json')) as jsonfile:
+                layout = json.load(jsonfile)
+            with open(self._path(key, '.npz'), 'rb') as npzfile:
+                arrays = dict(np.load(io.BytesIO(npzfile.read())))
+        except OSError:
+            return None
+        except (ValueError, KeyError, EOFError, zipfile.BadZipFile) as err:
+            logger = logging.getLogger('glodap.util.exccache')
+            logger.warning(
+                'Removing corrupt cache entry {}: {}'.format(key, err)
+            )
+            self._remove(key)
+            return None
+        # Mark as recently used
+        os.utime(self._path(key, '.npz'))
+
+        index = arrays['index']
+        dataframe = pd.DataFrame(
+            {
+                column['name']: _decode_column(column, arrays, index)
+                for column in layout['columns']
+            },
+            index=index,
+            columns=[column['name'] for column in layout['columns']],
+        )
+        return _set_exchange_metadata(dataframe, layout['metadata'])
+
+
+def content_hash(path, block_size=1024 * 1024):
+    """Return a hex digest of the content of the file at path"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as excfile:
+        for block in iter(lambda: excfile.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _encode_column(ix, series):
+    """
+    Return a (layout, arrays) tuple for storing series as numpy arrays
+    without pickling.
+    """
+    name = 'c{}'.format(ix)
+    if pd.api.types.is_categorical_dtype(series.dtype):
+        categories = series.cat.categories
+        return (
+            {
+                'kind': 'category',
+                'array': name,
+                'categories': name + '_categories',
+                'categories_kind': 'string'
+                    if categories.dtype == object else 'numeric',
+            },
+            {
+                name: np.asarray(series.cat.codes),
+                name + '_categories': np.asarray(
+                    categories,
+                    dtype=str if categories.dtype == object else None,
+                ),
+            },
+        )
+    if pd.api.types.is_datetime64tz_dtype(series.dtype):
+        return (
+            {'kind': 'datetime', 'array': name, 'tz': str(series.dt.tz)},
+            {name: np.asarray(series.dt.tz_convert('UTC').dt.tz_localize(None))},
+        )
+    if series.dtype == object:
+        mask = pd.isnull(series).values
+        return (
+            {'kind': 'string', 'array': name, 'mask': name + '_mask'},
+            {
+                name: np.asarray(series.where(~mask, '').astype(str), dtype=str),
+                name + '_mask': mask,
+            },
+        )
+    return {'kind': 'numeric', 'array': name}, {name: np.asarray(series)}
+
+def _decode_column(column, arrays, index):
+    """Rebuild a pandas series from the layout made by _encode_column"""
+    values = arrays[column['array']]
+    if column['kind'] == 'category':
+        categories = arrays[column['categories']]
+        if column['categories_kind'] == 'string':
+            categories = categories.astype(object)
+        return pd.Series(
+            pd.Categorical.from_codes(values, categories),
+            index=index,
+        )
+    if column['kind'] == 'datetime':
+        return pd.Series(values, index=index).dt.tz_localize(
+            'UTC'
+        ).dt.tz_convert(column['tz'])
+    if column['kind'] == 'string':
+        values = values.astype(object)
+        values[arrays[column['mask']]] = np.nan
+    return pd.Series(values, index=index)
@@ -1,10 +1,22 @@
+import os
 import re
+import io
+import mmap
+import codecs
 import logging
 import datetime
+import functools
+import itertools
+import concurrent.futures
 import pandas as pd
 import numpy as np
-from file_read_backwards import FileReadBackwards
 import dateutil.parser as parser
+from .data_type_dict import DataTypeDict
+
+
+# Version of the data frames returned by excread(). Bump it whenever the
+# parsing or cleaning changes, so cached data frames are read again
+_reader_version = 1
 
 
 @pd.api.extensions.register_dataframe_accessor("whp_exchange")
@@ -12,407 +24,779 @@ class ExchangeAccessor(object):
     """This accessor simply defines some metadata properties"""
     column_units = []
     file_signature = ''
+    signature = ''
     file_type = ''
     comments = ''
 
     def __init__(self, pandas_obj):
         self._obj = pandas_obj
 
-def excread(path):
+def excread(
+        path,
+        use_mmap=False,
+        compact=False,
+        params=None,
+        accepted_flags=None,
+):
     """Read a single, moderate-sized file defined in the WHP Exchange
     format (https://exchange-format.readthedocs.io/en/latest/)
 
     - path: path to exchange file to read
+    - use_mmap: memory-map the file, and parse the data block straight from
+      the mapped pages. Lowers peak memory for very large files, and lets
+      processes reading the same file share its pages.
+    - compact: store columns in the smallest suitable dtypes, see
+      compact_dtypes()
+    - params: list of parameters to read, as exchange names (e.g. SILCAT)
+      or glodap reference types (e.g. silicate). Only these columns, their
+      _FLAG_W columns and the station, position, time and depth columns
+      are parsed. If the file lacks any of the parameters, None is returned
+      after reading the header only.
+    - accepted_flags: if given, set values to NaN unless their WOCE flag is
+      one of these, e.g. (2, 6), see apply_quality_flags()
 
     Returns a pandas data frame object with the content parsed from the exc file.
     A column called EXC_DATETIME is added, holding actual date-time values for
     the file. If no times are found, time is set to 00:00
     A column EXC_CTDDEPTH is added holding sampling depth (from CTDDEP or CTDDEP)
-    """
 
-    logger = logging.getLogger('glodap.util.excread')
-    try:
-        encoding = "utf-8"
-        with open(path, encoding=encoding) as excfile:
-            excfile.readline()
-    except:
-        try:
-            encoding = "iso-8859-1"
-            with open(path, encoding=encoding) as excfile:
-                excfile.readline()
-                logger.info(
-                    'File {} character encoding is ISO-8859-1'.format(
-                        path
-                    )
-                )
-        except Exception as err:
-            logger.error(
-                'Could not read file {}'.format(
-                    path
-                )
-            )
-            raise err
-    return _excread(path, encoding=encoding)
-
-
-
-    #encoding_list = ['ascii','latin-1','iso-8859-1']
-        ##encoding_list = ['ascii','latin-1','iso-8859-1','ISO8601']
-    #for encoding in encoding_list:
-    #        worked = True
-    #try:
-    #        with open(path, encoding=encoding) as excfile:
-    #            excfile.readline()
-    #except:
-    #    print(encoding_list)
-      
-
-
-   ## logger = logging.getLogger('glodap.util.excread')
-########
-   ## encodingup = [
-   ##         'ascii',
-   ##         'utf-8',
-   ##         'iso-8859-1',
-   ##         'latin-1'
-##]
-  ##  info =None
-  ##  for encoding in encodingup:
-  ##      try:
-  ##          with open(path, encoding=encoding) as excfile:
-  ##              excfile.readline()
-  ##      except: 
-  ##          continue
-  ##      else:
-########            
-    #try:
-       # encoding = "utf-8"
-      #  with open(path, encoding=encoding) as excfile:
-     #       excfile.readline()
-    #except Exception:
-        #try: 
-            #encoding = "iso-8859-1"
-           # with open(path, encoding=encoding) as excfile:
-             #   excfile.readline()            
-            #    logger.info(
-           #         'File {} character encoding is ISO-8859-1'.format(
-          #              path
-         #           )
-        #        )
-        #except Exception:
-            #try:
-                #encoding = "latin-1"
-                #with open(path, encoding=encoding) as excfile:
-               #     excfile.readline()
-              #      logger.info(
-             #           'File {} character encoding is latin-1'.format(
-            #                path
-           #             )
-          #          )
-         #   except Exception as err:
-        #        logger.error(
-       #             'Could not read file {}'.format(
-      #                  path
-     #                )   
-     #            )
-    #        raise err
-    #     return _excread(path, encoding=encoding)
-
-
-def _excread(path, encoding="utf-8"):
-    """Dont call this directly, use excread() instead."""
-    logger = logging.getLogger('glodap.util.excread')
-    skipfooter = 0
-    first = True
-    signature = ''
-    file_type = ''
-    column_headers = []
-    column_units = []
-    line = None
-    headerlines = 0
-    comments = ""
-    sampl_depth_columns = [
-        'CTDDEPTH',
-        'CTDDEP',
-	'CTDPRS',
-    ]
+    Example:
 
-    # Loop over the header to collect metadata and remove file type info
-    with open(path, encoding=encoding) as excfile:
-        while True:
-            headerlines += 1
-            line = excfile.readline().strip()
-            # Get the file type and signature
-            if (
-                    first
-                    and (
-                        line.startswith('CTD')
-                        or line.startswith('BOTTLE')
-                    )
-            ):
-                first = False
-                matches = re.search('((BOTTLE)|(CTD))[, ](.*)$', line)
-                signature = matches.group(4)
-                file_type = matches.group(1)
-                continue
-            # ignore empty lines
-            elif not line.strip():
-                continue
-            # Keep comments as metadata
-            elif line.startswith('#'):
-                comments += line + "\n"
-                continue
-            else:
-                # Register header lines
-                if line.startswith('EXPOCODE'):
-                    column_headers = [s.strip() for s in line.split(',')]
-                elif line.startswith(',,,'):
-                    column_units =  [s.strip() for s in line.split(',')]
-                else:
-                    break
-
-   ## with FileReadBackwards(path, encoding=encoding) as fin:
-   ##     for line in fin:
-   ##         skipfooter += 1
-   ##         if line.strip() == 'END_DATA':
-   ##             break
-##############
-    #try:
-        ##encoding = "utf-8"    
-        ##with FileReadBackwards(path, encoding=encoding) as fin:
-        ##    for line in fin:
-        ##        skipfooter += 1
-        ##        if line.strip() == 'END_DATA': 
-        ##            break
-
-        encoding_list = ['ascii','latin-1','iso-8859-1']
-        ##encoding_list = ['ascii','latin-1','iso-8859-1','ISO8601']
-        for encoding in encoding_list:
-            worked = True
-        try:
-            with FileReadBackwards(path, encoding=encoding) as fin:
-                for line in fin:
-                    skipfooter += 1
-                    if line.strip() == 'END_DATA':
-                        continue
-        except:
-            worked = False
-        if worked:
-            print(encoding_list)
-
-   #except: 
-    ##   try:
-    ##        encoding = "iso-8859-1"
-    ##    with FileReadBackwards(path, encoding=encoding) as fin:
-    ##        for line in fin:
-    ##            skipfooter += 1
-    ##            if line.strip() == 'END_DATA':                    
-    ##    except:
-    ##        pass
-    ##        try:
-    ##    encoding = "latin-1"
-    ##    with FileReadBackwards(path, encoding=encoding) as fin:
-    ##        for line in fin:
-    ##            skipfooter += 1
-    ##            if line.strip() == 'END_DATA':                    
-    ##        except:
-    ##            pass
-
-##################
-
-    data_types = {
-        'EXPOCODE': str,
-        'SECT_ID': str,
-        'DATE': str,
-        'TIME': str,
-    }
+    >>> excread('33RR20160208_hy1.csv', params=['silicate', 'NITRAT'])
+    """
+    if use_mmap:
+        dataframe = _excread_mmap(path, params)
+    else:
+        dataframe = _excread(path, params)
+    if accepted_flags is not None and dataframe is not None:
+        dataframe = apply_quality_flags(dataframe, accepted_flags)
+    if compact and dataframe is not None:
+        dataframe = compact_dtypes(dataframe)
+    return dataframe
 
-    
-
-    
-    ##dataframe = pd.read_csv(
-    ##    path,
-    ##    names=column_headers,
-    ##    dtype=data_types,
-    ##    skiprows=headerlines,
-    ##    skipfooter=skipfooter,
-    ##    engine='python',
-    ##    encoding=encoding,
-   ## )
-          
-   ## dataframe = pd.read_csv(
-   ##     path,
-   ##     names=column_headers,
-   ##     dtype=data_types,
-   ##     skiprows=headerlines,
-   ##     nrows=1000,
-   ##     engine='python',
-   ##     encoding=encoding,
-   ##     index_col=False,
-   ##     warn_bad_lines=True,
-   ##     error_bad_lines=False,
-   ## )
-    
-    dataframe = pd.read_csv(
+def excread_chunks(
         path,
-        names=column_headers,
-        dtype=data_types,
-        skiprows=headerlines,
-        nrows=1500,
-        engine='python',
-        encoding=encoding,
-        index_col=False,
-        warn_bad_lines=True,
-        error_bad_lines=False,
-        sep = ',',
-    )
-    #keep_default_na =False,
+        chunksize=10000,
+        compact=False,
+        params=None,
+        accepted_flags=None,
+):
+    """Read a large file defined in the WHP Exchange format in chunks, with
+    bounded memory use.
 
-    #dataframe=dataframe.loc[:,~dataframe.columns.str.contains('^SAMPNO')]
-    #dataframe =dataframe['SAMPNO'].str.startswith ('SAMPNO')
-    #dataframe =dataframe.drop(columns='SAMPNO')
-    #print(f"dataFrame:\n{dataframe}\n")
-    #dataframe =dataframe.drop(dataframe.filter(regex='SAMPNO').columns, axis =1)
-    #print(f"dataFrame:\n{dataframe}\n")
+    - path: path to exchange file to read
+    - chunksize: maximum number of data rows in each chunk
+    - compact, params, accepted_flags: see excread(). If the file lacks any
+      of params, no chunks are generated
 
-    dataframe=dataframe.dropna(axis=0, how='any')
-    dataframe = dataframe.replace(to_replace='None', value=np.nan).dropna()
+    Returns a generator of pandas data frames, cleaned the same way as the
+    data frame from excread(). Every chunk carries the same whp_exchange
+    metadata. Example:
 
-    #dataframe=dataframe.loc[:,~dataframe.columns.str.contains('^SAMPNO')]
+    >>> for chunk in excread_chunks('33RR20160208_ct1.csv', chunksize=5000):
+    ...     print(len(chunk), chunk.whp_exchange.file_type)
+    """
+    chunks = _excread_chunks(path, chunksize=chunksize, params=params)
+    if accepted_flags is not None:
+        chunks = (
+            apply_quality_flags(chunk, accepted_flags) for chunk in chunks
+        )
+    if compact:
+        return (compact_dtypes(chunk) for chunk in chunks)
+    return chunks
+
+def excread_many(
+        paths,
+        workers=None,
+        ordered=True,
+        concat=False,
+        **kwargs
+):
+    """Read many files defined in the WHP Exchange format, parsing the files
+    in parallel on a pool of processes.
+
+    - paths: list of paths to exchange files to read
+    - workers: number of worker processes. Defaults to the number of CPUs,
+      workers=1 reads the files serially in the current process
+    - ordered: if True, results are returned in the order of paths,
+      otherwise in the order the files are completed
+    - concat: if True, return all data in one data frame instead
+    - kwargs: passed on to excread() for each file
+
+    Returns a generator of (path, dataframe, error) tuples, one for each
+    file. If a file could not be read, dataframe is None and error holds the
+    exception, the other files are still read. Files skipped because they
+    lack any of params (see excread()) have both dataframe and error None.
+
+    With concat=True a single pandas data frame is returned, with the column
+    EXC_SOURCE_FILE holding the path each row was read from. Files that could
+    not be read are logged and left out.
+    """
+    results = _map_files(
+        functools.partial(_excread_worker, **kwargs),
+        paths,
+        workers,
+        ordered,
+    )
+    if not concat:
+        return results
 
-    #dataframe = dataframe.astype('float',errors='ignore')
-    
-    #dataframe[~dataframe[df_obj.columns].isnull()]dataframe[[df_obj.columns]].astype(int)
+    frames = []
+    for path, dataframe, error in results:
+        if dataframe is not None:
+            frames.append(dataframe.assign(EXC_SOURCE_FILE=path))
+    if not frames:
+        return pd.DataFrame(columns=['EXC_SOURCE_FILE'])
+    return pd.concat(frames, ignore_index=True, sort=False)
 
+def excread_header(path):
+    """Read only the header of a file defined in the WHP Exchange format,
+    stopping at the first data line.
 
-    
+    - path: path to exchange file to read
 
+    Returns an ExchangeHeader with the signature, file_type, column_headers,
+    column_units, comments and expocode of the file. Example:
 
-    # Strip leading and trailing whitespaces from string columns
-    df_obj = dataframe.select_dtypes(['object'])
-    dataframe[df_obj.columns] = df_obj.apply(lambda x: x.str.strip())
-    
-    #dataframe[df_obj.columns] = dataframe[df_obj.columns].replace(np.NaN,0)
-    ##dataframe[df_obj.columns] = df_obj.apply(lambda x: x.str.strip())
+    >>> header = excread_header('33RR20160208_hy1.csv')
+    >>> header.expocode, 'TCARBN' in header.column_headers
+    ('33RR20160208', True)
+    """
+    excfile, header = _open_exchange(path)
+    excfile.close()
+    return header
 
-    # If 'TIME' not present but 'HOUR' and 'MINUTE' is, then make time :)
-    ##if (not 'TIME' in dataframe.columns
-    ##        and 'HOUR' in dataframe.columns
-    ##        and 'MINUTE' in dataframe.columns):
-    ##    dataframe['TIME'] = [
-    ##        f'{d.HOUR:02}{d.MINUTE:02}' for i, d in dataframe.iterrows()
-    ##    ]
+def scan_headers(paths, workers=None, ordered=True):
+    """Read the headers of many files defined in the WHP Exchange format,
+    e.g. to build an inventory of an archive.
 
+    - paths: list of paths to exchange files to read
+    - workers, ordered: see excread_many()
 
+    Returns a generator of (path, header, error) tuples, where header is
+    the ExchangeHeader returned by excread_header(), or None if the file
+    could not be read.
+    """
+    return _map_files(excread_header, paths, workers, ordered)
 
-    FilterCondition=dataframe['CASTNO'].between(1,200).values
-    dataframe.loc[FilterCondition, 'CASTNO']=0
-   
-    
+def compact_dtypes(dataframe):
+    """
+    Return a copy of an exchange data frame with columns stored in the
+    smallest suitable dtypes, and log the memory saved:
+
+    - WOCE flags (*_FLAG_W) and the counters STNNBR, CASTNO, SAMPNO and
+      BTLNBR are downcast to the smallest integer type (e.g. int8), or to
+      float32 if they have missing values
+    - measurements are stored as float32 if all values have at most 6
+      significant digits. They round-trip to 6 significant digits, but are
+      not exact (e.g. 35.4988 becomes 35.49879837 as float64), so later
+      statistics carry the float32 rounding error
+    - EXPOCODE, SECT_ID and other repeated strings become categoricals
+    """
+    logger = logging.getLogger('glodap.util.excread')
+    compact = dataframe.copy(deep=False)
+    for name in compact.columns:
+        column = compact[name]
+        if pd.api.types.is_bool_dtype(column.dtype):
+            continue
+        elif pd.api.types.is_numeric_dtype(column.dtype):
+            if name.endswith('_FLAG_W') or name in _counter_columns:
+                compact[name] = _downcast_integers(column)
+            elif pd.api.types.is_integer_dtype(column.dtype):
+                compact[name] = pd.to_numeric(column, downcast='integer')
+            elif (
+                    column.dtype == np.float64
+                    and _fits_float32(column.values)
+            ):
+                compact[name] = column.astype(np.float32)
+        elif column.dtype == object:
+            if (
+                    name in _category_columns
+                    or column.nunique() <= len(column) // 2
+            ):
+                compact[name] = column.astype('category')
+
+    before = dataframe.memory_usage(deep=True).sum()
+    after = compact.memory_usage(deep=True).sum()
+    logger.info(
+        'Compact dtypes use {} of {} bytes, saved {} bytes'.format(
+            after,
+            before,
+            before - after,
+        )
+    )
+    return _set_exchange_metadata(compact, _get_exchange_metadata(dataframe))
 
+def apply_quality_flags(dataframe, accepted_flags=(2, 6), params=None):
+    """
+    Return a copy of an exchange data frame where the values of each
+    parameter with a _FLAG_W column are set to NaN unless their WOCE quality
+    flag is one of accepted_flags. Values with a missing flag are set to
+    NaN too. All rows are kept, so each parameter is filtered on its own.
 
-    #FilterCondition=dataframe['DATE'].between(100209,100220).values
-    #dataframe.loc[FilterCondition, 'DATE']=20100209
+    - accepted_flags: WOCE flags of values to keep, by default 2
+      (acceptable) and 6 (mean of replicates)
+    - params: names of the parameters to filter, by default all with a
+      _FLAG_W column
 
-    if (not 'TIME' in dataframe.columns
-            and 'HOUR' in dataframe.columns
-            and 'MINUTE' in dataframe.columns):
-        dataframe['TIME'] = [
-            f'{d.HOUR:02}{d.MINUTE:02}' for i, d in dataframe.iterrows()
-        ]
-    elif (not 'TIME' in dataframe.columns):
-         dataframe['TIME'] = [
-                f'{d.CASTNO:06}' for i, d in dataframe.iterrows()
-        ]
-    elif ('TIME' in dataframe.columns):
-        dataframe['TIME'] = [
-                f'{d.CASTNO:06}' for i, d in dataframe.iterrows()
+    All flagged parameters are masked at once, as one float array of values
+    and one of flags. Example:
+
+    >>> data = apply_quality_flags(excread('33RR20160208_hy1.csv'), (2,))
+    """
+    if params is None:
+        params = [
+            name[:-len('_FLAG_W')] for name in dataframe.columns
+            if name.endswith('_FLAG_W')
         ]
-    else:
-        print(df_obj)
+    params = [
+        name for name in params
+        if name in dataframe.columns and name + '_FLAG_W' in dataframe.columns
+    ]
+    output = dataframe.copy()
+    if params:
+        values = output[params].values.astype(float)
+        flags = output[[name + '_FLAG_W' for name in params]].values.astype(
+            float
+        )
+        values[~np.isin(flags, accepted_flags)] = np.nan
+        for ix, name in enumerate(params):
+            output[name] = values[:, ix]
+    return _set_exchange_metadata(output, _get_exchange_metadata(dataframe))
+
+# Columns holding small integer counters, and repeated strings
+_counter_columns = ['STNNBR', 'CASTNO', 'SAMPNO', 'BTLNBR']
+_category_columns = ['EXPOCODE', 'SECT_ID']
+
+def _downcast_integers(column):
+    """Downcast a column of integer values, floats if values are missing"""
+    values = column.values
+    if (
+            pd.api.types.is_integer_dtype(column.dtype)
+            or (
+                not np.isnan(values).any()
+                and np.array_equal(values, np.round(values))
+            )
+    ):
+        return pd.to_numeric(column, downcast='integer')
+    return pd.to_numeric(column, downcast='float')
 
+def _fits_float32(values):
+    """
+    Return True if all values have at most 6 significant digits, so they
+    round-trip through float32 to 6 significant digits
+    """
+    values = values[np.isfinite(values) & (values != 0)]
+    if len(values) == 0:
+        return True
+    scale = 10.0 ** (5 - np.floor(np.log10(np.abs(values))))
+    return np.allclose(
+        np.round(values * scale) / scale,
+        values,
+        rtol=1e-12,
+        atol=0,
+    )
 
-        #if (not 'TIME' in dataframe.columns):
-        # dataframe['TIME'] = [
-        #        f'{d.STNNBR:06}' for i, d in dataframe.iterrows()
-        #]
+def _excread_worker(path, **kwargs):
+    """Read one file in a worker process, returning data and metadata"""
+    dataframe = excread(path, **kwargs)
+    if dataframe is None:
+        return None
+    return dataframe, _get_exchange_metadata(dataframe)
+
+def _get_exchange_metadata(dataframe):
+    """Return the whp_exchange metadata of dataframe as a dict"""
+    return {
+        'column_units': dataframe.whp_exchange.column_units,
+        'signature': dataframe.whp_exchange.signature,
+        'file_type': dataframe.whp_exchange.file_type,
+        'comments': dataframe.whp_exchange.comments,
+    }
 
-    #if 'DATE' in dataframe.columns:
-    #    datetime =[]
-    #    d1=pd.to_datetime(dataframe['DATE'],format='%y%m%d')
-    #    print(dataframe['DATE'])
-        #dataframe['DATE']=d1.dt.strftime('%Y%b%d')
-    #    dataframe['DATE']=pd.to_datetime(d1,format='%Y%m%d')
-    #    print(dataframe['DATE'])
-    #    dataframe['DATE']=dataframe['DATE'].dt.strftime('%Y%m%d').astype(object)
-    #    print(dataframe['DATE'])
+def _set_exchange_metadata(dataframe, metadata):
+    """Set the whp_exchange metadata of dataframe from a dict"""
+    for key, value in metadata.items():
+        setattr(dataframe.whp_exchange, key, value)
+    return dataframe
 
-        #dataframe['DATE']= pd.to_datetime(dataframe['DATE'],format='%y%m%d')
-        #dataframe['DATE'] = datetime.strptime(['DATE'],'%y%m%d')
-        #dataframe['DATE'] = dataframe['DATE'].strftime('%Y%b%d')
-        #dataframe['DATE']= pd.to_datetime(dataframe['DATE'],format='%Y%b%d') 
-    #return dataframe
+def _map_files(func, paths, workers=None, ordered=True):
+    """
+    Call func(path) for each path on a process pool. Generates
+    (path, result, error) tuples. Data frames returned as (dataframe,
+    metadata) have their whp_exchange metadata restored, since it is lost
+    when pickled back from the worker.
+    """
+    logger = logging.getLogger('glodap.util.excread')
+    paths = iter(paths)
 
+    def _result(path, call):
+        try:
+            result = call()
+        except Exception as err:
+            logger.error('Could not read file {}: {}'.format(path, err))
+            return path, None, err
+        if isinstance(result, tuple):
+            result = _set_exchange_metadata(*result)
+        return path, result, None
+
+    if workers == 1:
+        for path in paths:
+            yield _result(path, lambda: func(path))
+        return
+
+    # Bound the number of results held in memory, files are only submitted
+    # as the results of earlier ones are consumed
+    max_pending = 2 * (workers or os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+
+        def _submit():
+            for path in itertools.islice(paths, max_pending - len(futures)):
+                futures[pool.submit(func, path)] = path
 
-  #dataframe['DATE']=pd.to_datetime('{} {}'.format(date,time))
-  # print(DATE)
-     
+        try:
+            _submit()
+            while futures:
+                if ordered:
+                    done = [ next(iter(futures)) ]
+                else:
+                    done, _ = concurrent.futures.wait(
+                        futures,
+                        return_when=concurrent.futures.FIRST_COMPLETED,
+                    )
+                for future in done:
+                    yield _result(futures.pop(future), future.result)
+                _submit()
+        finally:
+            for future in futures:
+                future.cancel()
 
+# Number of bytes read for detecting the character encoding of a file
+_encoding_sample_size = 64 * 1024
 
-    # Add a datetime column
-    if 'DATE' in dataframe.columns and 'TIME' in dataframe.columns:
-        datetime = []
+def _detect_encoding(sample):
+    """
+    Return the character encoding of a file from a sample of its first
+    bytes. Files are UTF-8 if the sample decodes as such, otherwise
+    ISO-8859-1, which can decode any byte.
+    """
+    try:
+        # Not final, the sample may end inside a multi-byte character
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'iso-8859-1'
 
-        
+def _open_exchange(path):
+    """
+    Open an exchange file for reading in binary mode, and read its header.
+    Returns (excfile, header).
+    """
+    excfile = open(path, 'rb')
+    try:
+        header = _read_exchange_header(path, excfile)
+    except Exception:
+        excfile.close()
+        raise
+    return excfile, header
+
+def _read_exchange_header(path, source):
+    """
+    Read the header from source, a file or mmap at the start of the exchange
+    file at path. The character encoding is detected from a sample read
+    from the same source, so the file is only opened once.
+    """
+    logger = logging.getLogger('glodap.util.excread')
+    try:
+        encoding = _detect_encoding(source.read(_encoding_sample_size))
+        source.seek(0)
+        header = _read_header(source, encoding)
+    except Exception as err:
+        logger.error(
+            'Could not read file {}'.format(
+                path
+            )
+        )
+        raise err
+    if header.encoding != 'utf-8':
+        logger.info(
+            'File {} character encoding is ISO-8859-1'.format(
+                path
+            )
+        )
+    return header
 
-        
+class ExchangeHeader(object):
+    """
+    Metadata collected from the header of a WHP Exchange file. The first
+    data line is kept, so reading can continue from the same file handle
+    without a second pass over the header. The expocode is taken from the
+    first data line.
+    """
+    def __init__(self):
+        self.signature = ''
+        self.file_type = ''
+        self.column_headers = []
+        self.column_units = []
+        self.comments = ''
+        self.expocode = None
+        self.encoding = 'utf-8'
+        self.headerlines = 0
+        self.first_data_line = None
+
+
+def _read_header(excfile, encoding='utf-8'):
+    """
+    Read the header of an exchange file open in binary mode, leaving the
+    file positioned after the first data line. Header lines are decoded
+    using encoding, falling back to ISO-8859-1 for lines which cannot be
+    decoded. Returns an ExchangeHeader.
+    """
+    header = ExchangeHeader()
+    header.encoding = encoding
+    first = True
+    while True:
+        raw_line = excfile.readline()
+        if not raw_line:
+            # End of file without any data
+            break
         try:
-                d1=pd.to_datetime(dataframe['DATE'],format='%y%m%d')
-                dataframe['DATE']=pd.to_datetime(d1,format='%Y%m%d')
-                dataframe['DATE']=dataframe['DATE'].dt.strftime('%Y%m%d').astype(object)
-        except:
-                dataframe['DATE']=dataframe['DATE']
+            line = raw_line.decode(header.encoding).strip()
+        except UnicodeDecodeError:
+            header.encoding = 'iso-8859-1'
+            line = raw_line.decode(header.encoding).strip()
+        # Get the file type and signature
+        if (
+                first
+                and (
+                    line.startswith('CTD')
+                    or line.startswith('BOTTLE')
+                )
+        ):
+            first = False
+            matches = re.search('((BOTTLE)|(CTD))[, ](.*)$', line)
+            header.signature = matches.group(4)
+            header.file_type = matches.group(1)
+        # ignore empty lines
+        elif not line:
+            pass
+        # Keep comments as metadata
+        elif line.startswith('#'):
+            header.comments += line + "\n"
+        # Register header lines
+        elif line.startswith('EXPOCODE'):
+            header.column_headers = [s.strip() for s in line.split(',')]
+        elif line.startswith(',,,'):
+            header.column_units = [s.strip() for s in line.split(',')]
+        else:
+            header.first_data_line = raw_line
+            if 'EXPOCODE' in header.column_headers:
+                values = line.split(',')
+                ix = header.column_headers.index('EXPOCODE')
+                if ix < len(values):
+                    header.expocode = values[ix].strip()
+            break
+        header.headerlines += 1
+    return header
 
-        
+
+class _ExchangeDataBlock(io.RawIOBase):
+    """
+    Binary stream over the data block of an open exchange file, starting at
+    the first data line found by _read_header() and ending at END_DATA.
+    Handed directly to pandas.read_csv, so the C parser can be used instead
+    of counting footer lines for skipfooter, and only string columns are
+    decoded. Use _data_block() to get a buffered stream.
+    """
+    def __init__(self, excfile, first_data_line):
+        super().__init__()
+        self._file = excfile
+        self._pending = first_data_line
+        self._done = first_data_line is None
+        self._buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def _next_line(self):
+        if self._done:
+            return b''
+        if self._pending is not None:
+            line = self._pending
+            self._pending = None
+        else:
+            line = self._file.readline()
+        if not line or line.strip() == b'END_DATA':
+            self._done = True
+            return b''
+        return line
+
+    def readinto(self, buffer):
+        if not self._buffer:
+            lines = []
+            length = 0
+            while length < len(buffer):
+                line = self._next_line()
+                if not line:
+                    break
+                lines.append(line)
+                length += len(line)
+            self._buffer = memoryview(b''.join(lines))
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+class _MappedDataBlock(io.RawIOBase):
+    """
+    Binary stream over the data block of a memory-mapped exchange file,
+    between the byte offsets start and end. Data is copied from the mapped
+    pages straight into the buffer of the reader, without building line
+    objects.
+    """
+    def __init__(self, mapped, start, end):
+        super().__init__()
+        self._view = memoryview(mapped)[start:end]
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self._view) - self._position)
+        buffer[:size] = self._view[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+def _data_block(excfile, header):
+    """Return a buffered binary stream over the data block of excfile"""
+    return io.BufferedReader(
+        _ExchangeDataBlock(excfile, header.first_data_line)
+    )
 
 
+def _excread(path, params=None):
+    """Dont call this directly, use excread() instead."""
+    # Read header, data block and END_DATA in one forward pass
+    excfile, header = _open_exchange(path)
+    with excfile:
+        usecols = _param_columns(path, header, params)
+        if usecols is False:
+            return None
+        position = excfile.tell()
+
+        def _open_block():
+            excfile.seek(position)
+            return _data_block(excfile, header)
+
+        dataframe = _read_data_block(path, header, _open_block, usecols)
+    return _clean_exchange_frame(dataframe, header, usecols)
+
+# END_DATA line, matching the lines _ExchangeDataBlock stops at
+_end_data = re.compile(
+    rb'^[ \t\r\f\v]*END_DATA[ \t\r\f\v]*$',
+    re.MULTILINE,
+)
+
+def _excread_mmap(path, params=None):
+    """Dont call this directly, use excread(path, use_mmap=True) instead."""
+    with open(path, 'rb') as excfile:
+        if os.fstat(excfile.fileno()).st_size == 0:
+            # Empty files can not be mapped
+            return _excread(path, params)
+        with mmap.mmap(
+                excfile.fileno(),
+                0,
+                access=mmap.ACCESS_READ,
+        ) as mapped:
+            header = _read_exchange_header(path, mapped)
+            usecols = _param_columns(path, header, params)
+            if usecols is False:
+                return None
+            start = mapped.tell()
+            if header.first_data_line is not None:
+                start -= len(header.first_data_line)
+            end = _end_data.search(mapped, start)
+            end = len(mapped) if end is None else end.start()
+            blocks = []
+
+            def _open_block():
+                blocks.append(_MappedDataBlock(mapped, start, end))
+                return io.BufferedReader(blocks[-1])
 
-        for ix, d in enumerate(dataframe['DATE'],start=0):
-         
             try:
-                t = dataframe['TIME'][ix]
-                print (ix,d)
-                date='{}-{}-{}'.format(d[:4], d[4:6], d[6:])
-
-               
-                #try:
-                #    date=d2
-                #except:
-                #    date=d1
-
-                #date= dataframe['DATE'].apply(lambda d:.format(d[:4], d[4:6], d[6:]
-                #date = filter(lambda d: d is not None,'{}-{}-{}'.format(d[:4], d[4:6], d[6:]))
-                
-                #print(date)
-                #date='{}-{}-{}'.format(d[:4], d[4:6], d[6:])
-                #print(d)
-                #date='{}-{}-{}'.format(d[:4], d[4:6], d[6:])
-                #print(date)
-                time = '{}:{}'.format(t[:2], t[2:])               
-                datetime.append(pd.to_datetime('{} {}'.format(date,time), utc=True))
-                #datetime.append(pd.to_datetime(str(dataframe['DATE'])))
-            except Exception as e:
-                logger.error(
-                        'Time format error (date: {} time: {} )) on line {}'
-                            .format(
-                            d,
-                            t,
-                            ix + headerlines
-                    )
+                dataframe = _read_data_block(
+                    path,
+                    header,
+                    _open_block,
+                    usecols,
+                )
+            finally:
+                # Views into the map must be released before it is closed
+                for block in blocks:
+                    block.close()
+    return _clean_exchange_frame(dataframe, header, usecols)
+
+def _excread_chunks(path, chunksize=10000, params=None):
+    """Dont call this directly, use excread_chunks() instead."""
+    excfile, header = _open_exchange(path)
+    with excfile:
+        usecols = _param_columns(path, header, params)
+        if usecols is False:
+            return
+        position = excfile.tell()
+        rows = 0
+        while True:
+            # Restarted after the rows already read, if the data block has
+            # to be decoded as ISO-8859-1, see _read_data_block()
+            excfile.seek(position)
+            reader = pd.read_csv(
+                _data_block(excfile, header),
+                chunksize=chunksize,
+                skiprows=rows,
+                **_read_csv_options(header, usecols)
+            )
+            offset = rows
+            try:
+                for chunk in reader:
+                    chunk.index += offset
+                    rows += len(chunk)
+                    yield _clean_exchange_frame(chunk, header, usecols)
+                return
+            except UnicodeDecodeError:
+                _fall_back_to_latin1(path, header)
+
+# Columns always read with the requested params of excread()
+_key_columns = [
+    'EXPOCODE', 'SECT_ID', 'STNNBR', 'CASTNO', 'SAMPNO', 'BTLNBR',
+    'DATE', 'TIME', 'HOUR', 'MINUTE', 'LATITUDE', 'LONGITUDE', 'DEPTH',
+    'CTDPRS', 'CTDDEP', 'CTDDEPTH',
+]
+
+def _param_columns(path, header, params):
+    """
+    Return the columns of an exchange file to read for params, see
+    excread(): None to read all columns if params is None, or False if the
+    file lacks any of params. A parameter found in the column headers by
+    name is read as is, otherwise all exchange columns of its glodap
+    reference type are read (e.g. CTDSAL and SALNTY for salinity).
+    """
+    logger = logging.getLogger('glodap.util.excread')
+    if params is None:
+        return None
+    if isinstance(params, str):
+        params = [ params ]
+    data_types = DataTypeDict()
+    columns = set(_key_columns)
+    for name in params:
+        found = [name] if name in header.column_headers else []
+        ref_type = data_types.reference_type(name)
+        if not found and ref_type is not None:
+            found = [
+                column for column in data_types.get_exchange_names(
+                    data_types[ref_type].identifier
                 )
-                raise e
-        dataframe['EXC_DATETIME'] = datetime
-    
+                if column in header.column_headers
+            ]
+        if not found:
+            logger.info('Skipping file {}, no {} column'.format(path, name))
+            return False
+        columns.update(found)
+        columns.update(column + '_FLAG_W' for column in found)
+    return [column for column in header.column_headers if column in columns]
+
+def _read_data_block(path, header, open_block, usecols=None):
+    """
+    Read the data block of an exchange file with pandas.read_csv. The
+    encoding is detected from a sample at the start of the file, so a
+    non-UTF-8 byte may only show up in the data block. The block is then
+    read again as ISO-8859-1, which can decode any byte. open_block()
+    returns a new binary stream over the data block for each attempt.
+    """
+    try:
+        return pd.read_csv(open_block(), **_read_csv_options(header, usecols))
+    except UnicodeDecodeError:
+        _fall_back_to_latin1(path, header)
+    return pd.read_csv(open_block(), **_read_csv_options(header, usecols))
+
+def _fall_back_to_latin1(path, header):
+    """Switch header to ISO-8859-1 after a decode error in the data block"""
+    logger = logging.getLogger('glodap.util.excread')
+    if header.encoding == 'iso-8859-1':
+        raise Exception(
+            'Could not decode file {} as ISO-8859-1'.format(path)
+        )
+    logger.info(
+        'File {} data is not UTF-8, reading it as ISO-8859-1'.format(path)
+    )
+    header.encoding = 'iso-8859-1'
+
+def _read_csv_options(header, usecols=None):
+    """Options for pandas.read_csv shared by all exchange data block reads"""
+    data_types = {
+        'EXPOCODE': str,
+        'SECT_ID': str,
+        'DATE': str,
+        'TIME': str,
+    }
+    return dict(
+        names=header.column_headers,
+        usecols=usecols,
+        dtype=data_types,
+        encoding=header.encoding,
+        engine='c',
+        index_col=False,
+        warn_bad_lines=True,
+        error_bad_lines=False,
+        sep = ',',
+    )
+
+def _clean_exchange_frame(dataframe, header, usecols=None):
+    """
+    Clean a data frame read from the data block of an exchange file, and
+    attach the header metadata to it. The index of the data frame is
+    expected to be the row number in the data block, also for chunks.
+    If only usecols were read, column_units holds the units of those.
+    """
+    column_units = header.column_units
+    if usecols is not None:
+        units = dict(zip(header.column_headers, header.column_units))
+        column_units = [units.get(column, '') for column in usecols]
+    signature = header.signature
+    file_type = header.file_type
+    comments = header.comments
+    headerlines = header.headerlines
+    sampl_depth_columns = [
+        'CTDDEPTH',
+        'CTDDEP',
+        'CTDPRS',
+    ]
+
+    # Strip leading and trailing whitespaces from string columns, and set
+    # 'None' values to NaN. Rows are kept, missing values are handled per
+    # parameter, see apply_quality_flags()
+    df_obj = dataframe.select_dtypes(['object'])
+    dataframe[df_obj.columns] = df_obj.apply(
+        lambda x: x.str.strip().replace('None', np.nan)
+    )
+
+    # If 'TIME' not present but 'HOUR' and 'MINUTE' is, then make time :)
+    if ('TIME' not in dataframe.columns
+            and 'HOUR' in dataframe.columns
+            and 'MINUTE' in dataframe.columns):
+        dataframe['TIME'] = (
+            _zero_pad(dataframe['HOUR'], 2)
+            + _zero_pad(dataframe['MINUTE'], 2)
+        )
+
+    # Add a datetime column
+    if 'DATE' in dataframe.columns:
+        dataframe['EXC_DATETIME'] = _exchange_datetime(dataframe, headerlines)
 
     # Try multiple sampling depth columns
     for name in sampl_depth_columns:
@@ -420,14 +804,9 @@ def _excread(path, encoding="utf-8"):
             dataframe['EXC_CTDDEPTH'] = dataframe[name]
             break
 
-    
-    #dataframe=dataframe.loc[:,~dataframe.columns.str.contains('^SAMPNO')]
-
-
     # Replace -9999, -999, -99, -9 with np.nan
+    dataframe = _replace_sentinels(dataframe)
 
-    dataframe = dataframe.replace([-9999, -999, -99, -9], np.nan)
-    
     # Add some extra metadata to the dataframe
     dataframe.whp_exchange.column_units = column_units
     dataframe.whp_exchange.signature = signature
@@ -435,3 +814,90 @@ def _excread(path, encoding="utf-8"):
     dataframe.whp_exchange.comments = comments
 
     return dataframe
+
+# Values used for missing data in exchange files
+_sentinel_values = [-9999, -999, -99, -9]
+
+def _replace_sentinels(dataframe):
+    """
+    Set the missing data sentinels in the numeric columns of dataframe to
+    NaN, in a single pass over one float array of those columns. Only
+    columns holding sentinels are replaced.
+    """
+    numeric = [
+        name for name, dtype in dataframe.dtypes.items()
+        if dtype.kind in 'iuf'
+    ]
+    if not numeric:
+        return dataframe
+    values = dataframe[numeric].values.astype(float)
+    missing = values == _sentinel_values[0]
+    for sentinel in _sentinel_values[1:]:
+        missing |= values == sentinel
+    changed = missing.any(axis=0)
+    if not changed.any():
+        return dataframe
+    values[missing] = np.nan
+    for ix in np.flatnonzero(changed):
+        dataframe[numeric[ix]] = values[:, ix]
+    return dataframe
+
+def _zero_pad(series, width):
+    """Format a numeric series as zero padded integer strings"""
+    return pd.to_numeric(series, errors='coerce').fillna(0).astype(int).astype(
+        str
+    ).str.zfill(width)
+
+def _exchange_datetime(dataframe, headerlines=0):
+    """
+    Return a series of UTC date-times built from the DATE and TIME columns
+    of dataframe, in one vectorized to_datetime call. Dates given as YYMMDD
+    are expanded to YYYYMMDD in the DATE column. If TIME is missing, time is
+    set to 00:00. Rows with unparsable date or time are set to NaT, and
+    reported together in one log message.
+    """
+    logger = logging.getLogger('glodap.util.excread')
+    dates = dataframe['DATE'].astype(str).str.strip()
+    short = dates.str.len() == 6
+    if short.any():
+        century = pd.Series(
+            np.where(dates.str[:2] < '69', '20', '19'),
+            index=dates.index,
+        )
+        dates = dates.where(~short, century + dates)
+        dataframe['DATE'] = dates
+
+    if 'TIME' in dataframe.columns:
+        times = dataframe['TIME'].fillna('0000').astype(str).str.strip()
+        times = times.str.replace(':', '').str.zfill(4)
+    else:
+        times = pd.Series('0000', index=dates.index)
+
+    datetimes = pd.to_datetime(
+        dates + times,
+        format='%Y%m%d%H%M',
+        errors='coerce',
+        utc=True,
+    )
+
+    bad = datetimes.isnull()
+    if bad.any():
+        bad_rows = dataframe.loc[bad]
+        logger.error(
+            'Time format error on {} lines: {}'.format(
+                len(bad_rows),
+                ', '.join(
+                    '{} (date: {} time: {})'.format(
+                        ix + headerlines + 1,
+                        d,
+                        t,
+                    )
+                    for ix, d, t in zip(
+                        bad_rows.index[:20],
+                        dates[bad][:20],
+                        times[bad][:20],
+                    )
+                ),
+            )
+        )
+    return datetimes
@@ -1,4 +1,8 @@
 from math import sin, cos, sqrt, atan2, radians
+import numpy as np
+
+# Approx. earth radius, km
+_earth_radius = 6373.0
 
 def haversine_distance(lon1, lat1, lon2, lat2):
     """
@@ -7,8 +11,7 @@ def haversine_distance(lon1, lat1, lon2, lat2):
 
     Returns the distance in meters
     """
-    # Approx. earth radius, km
-    R = 6373.0
+    R = _earth_radius
     lon1 = radians(lon1)
     lat1 = radians(lat1)
     lon2 = radians(lon2)
@@ -20,3 +23,117 @@ def haversine_distance(lon1, lat1, lon2, lat2):
     distance = R * c * 1000
 
     return distance
+
+def haversine_distance_array(lon1, lat1, lon2, lat2):
+    """
+    Same as haversine_distance, for arrays of points. The arrays are
+    broadcast against each other, so e.g. the distances from one point to
+    many points can be calculated with scalar lon1 and lat1.
+
+    Returns the distances in meters
+
+    >>> lon = np.array([-20.0, 5.3, 179.5])
+    >>> lat = np.array([60.0, -33.1, 10.0])
+    >>> np.allclose(
+    ...     haversine_distance_array(lon, lat, 0, 0),
+    ...     [haversine_distance(x, y, 0, 0) for x, y in zip(lon, lat)],
+    ... )
+    True
+    """
+    lon1, lat1, lon2, lat2 = (
+        np.radians(np.asarray(value, dtype=float))
+        for value in (lon1, lat1, lon2, lat2)
+    )
+    return _haversine(
+        lon1,
+        lat1,
+        np.cos(lat1),
+        lon2,
+        lat2,
+        np.cos(lat2),
+    )
+
+def pairwise_haversine_distance(lon1, lat1, lon2, lat2, chunksize=1024):
+    """
+    Get the matrix of distances between each point in (lon1, lat1) and each
+    point in (lon2, lat2), e.g. between the stations of two cruises. The
+    matrix is filled chunksize rows at a time, bounding the memory used for
+    temporary arrays.
+
+    Returns an array of distances in meters, with shape
+    (len(lon1), len(lon2))
+
+    >>> d = pairwise_haversine_distance([0, 10], [0, 50], [1, 2, 3], [1, 2, 3])
+    >>> d.shape
+    (2, 3)
+    >>> np.isclose(d[1, 2], haversine_distance(10, 50, 3, 3))
+    True
+    """
+    points1 = _prepare_points(lon1, lat1)
+    points2 = _prepare_points(lon2, lat2)
+    distances = np.empty((len(points1[0]), len(points2[0])))
+    for start in range(0, len(points1[0]), chunksize):
+        rows = slice(start, start + chunksize)
+        distances[rows] = _haversine(
+            *(value[rows, np.newaxis] for value in points1),
+            *(value[np.newaxis, :] for value in points2),
+        )
+    return distances
+
+def stations_within_distance(
+        lon1,
+        lat1,
+        lon2,
+        lat2,
+        max_distance,
+        chunksize=1024,
+):
+    """
+    Find all pairs of points from (lon1, lat1) and (lon2, lat2) within
+    max_distance meters of each other, without building the full distance
+    matrix. Memory use is bounded by chunksize * len(lon2).
+
+    Returns a tuple (index_1, index_2, distance) of arrays, one element per
+    pair within max_distance.
+    """
+    points1 = _prepare_points(lon1, lat1)
+    points2 = _prepare_points(lon2, lat2)
+    index_1 = []
+    index_2 = []
+    distance = []
+    for start in range(0, len(points1[0]), chunksize):
+        rows = slice(start, start + chunksize)
+        chunk = _haversine(
+            *(value[rows, np.newaxis] for value in points1),
+            *(value[np.newaxis, :] for value in points2),
+        )
+        i, j = np.nonzero(chunk <= max_distance)
+        index_1.append(i + start)
+        index_2.append(j)
+        distance.append(chunk[i, j])
+    if not index_1:
+        return (
+            np.array([], dtype=int),
+            np.array([], dtype=int),
+            np.array([], dtype=float),
+        )
+    return (
+        np.concatenate(index_1),
+        np.concatenate(index_2),
+        np.concatenate(distance),
+    )
+
+def _prepare_points(lon, lat):
+    """Return 1-D arrays of lon and lat in radians, and cos(lat)"""
+    lon = np.radians(np.atleast_1d(np.asarray(lon, dtype=float)))
+    lat = np.radians(np.atleast_1d(np.asarray(lat, dtype=float)))
+    return lon, lat, np.cos(lat)
+
+def _haversine(lon1, lat1, cos_lat1, lon2, lat2, cos_lat2):
+    """Vectorized haversine formula on coordinates in radians, in meters"""
+    a = (
+        np.sin((lat2 - lat1) / 2)**2
+        + cos_lat1 * cos_lat2 * np.sin((lon2 - lon1) / 2)**2
+    )
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return _earth_radius * c * 1000
@@ -3,7 +3,12 @@ from typing import Tuple
 import pandas as pd
 import numpy as np
 import scipy.interpolate as interp
+import os
 import math
+import logging
+import hashlib
+import collections
+import concurrent.futures
 
 def average_values_for_duplicate_dimension(
         data: pd.DataFrame,
@@ -52,7 +57,9 @@ def pchip_interpolate_profile(
         x: list,
         y: list,
         x_interp: list=[],
-        step: float=1
+        step: float=1,
+        cache: 'PchipCache'=None,
+        profile_id=None,
 ):
     """
     Interpolates list y with respect to list x. If x_interp is given, this is
@@ -68,6 +75,9 @@ def pchip_interpolate_profile(
     array([289.76871469, 377.05063821, 414.5480226 , 439.11383135,
            460.84104938, 480.20833333, 494.94598765])
 
+    If a PchipCache is given as cache, the fitted interpolator is taken from
+    the cache when the same profile (same profile_id and data) has been
+    interpolated before, e.g. onto another grid.
     """
     # check input vars are equal length
     if len(x) != len(y):
@@ -81,6 +91,18 @@ def pchip_interpolate_profile(
             step=step,
         )
 
+    if cache is None:
+        pchip = _fit_pchip(x, y)
+    else:
+        pchip = cache.get(x, y, profile_id)
+    y_interp = pchip(x_interp)
+    return x_interp, y_interp
+
+def _fit_pchip(x: list, y: list):
+    """
+    Return a PchipInterpolator for y with respect to x, after removing
+    nans and sorting by x
+    """
     # Remove nans
     xx = []
     yy = []
@@ -90,16 +112,67 @@ def pchip_interpolate_profile(
         xx.append(x_)
         yy.append(y_)
 
-    # Sort by xx
-    xx, yy = (list(x) for x in zip(*sorted(zip(xx, yy))))
-
     if len(yy)<2:
         # Interpolation not possible
         raise Exception("Input data has less than 2 valid elements")
 
-    pchip = interp.PchipInterpolator(xx, yy, extrapolate=False)
-    y_interp = pchip(x_interp)
-    return x_interp, y_interp
+    # Sort by xx
+    xx, yy = (list(x) for x in zip(*sorted(zip(xx, yy))))
+
+    return interp.PchipInterpolator(xx, yy, extrapolate=False)
+
+class PchipCache():
+    """
+    Least recently used cache of fitted PchipInterpolators, for profiles
+    which are interpolated many times, e.g. against different reference
+    cruises or with different steps. Usage:
+
+    >>> cache = PchipCache(maxsize=10000)
+    >>> x, y = pchip_interpolate_profile(depth, silicate, step=10,
+    ...     cache=cache, profile_id=('06AQ20110805', 1, 1))
+    >>> cache.hits, cache.misses
+    (0, 1)
+
+    Interpolators are keyed by profile_id and a hash of the x and y data,
+    so a changed profile is never served from the cache. At most maxsize
+    interpolators are kept.
+    """
+    def __init__(self, maxsize: int=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._interpolators = collections.OrderedDict()
+
+    def get(self, x: list, y: list, profile_id=None):
+        """Return the interpolator for x and y, fitting it on a miss"""
+        key = (profile_id, _fingerprint(x, y))
+        pchip = self._interpolators.get(key)
+        if pchip is not None:
+            self.hits += 1
+            self._interpolators.move_to_end(key)
+            return pchip
+        self.misses += 1
+        pchip = _fit_pchip(x, y)
+        self._interpolators[key] = pchip
+        while len(self._interpolators) > self.maxsize:
+            self._interpolators.popitem(last=False)
+        return pchip
+
+    def clear(self):
+        self._interpolators.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._interpolators)
+
+def _fingerprint(x: list, y: list):
+    """Return a hash of the values in x and y"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(x, dtype=float).tobytes())
+    digest.update(b'|')
+    digest.update(np.ascontiguousarray(y, dtype=float).tobytes())
+    return digest.digest()
 
 def generate_regular_monotonus_squence(
         _min:float=1500,
@@ -127,16 +200,123 @@ def generate_regular_monotonus_squence(
     """
     _min=math.ceil(_min/step)
     _max=math.floor(_max/step)
-    numsteps = _max - _min + 1
     dimension = [
-        *np.linspace(
-            _min * step,
-            _max * step,
-            numsteps
-        )
+        *(np.arange(_min, _max + 1) * float(step))
     ]
     return dimension
 
+# Range of the canonical grid for each independent variable, see
+# get_regular_grid(). The potential density ranges hold all water from
+# fresh at 35 degC to salinity 42 at -2 degC
+grid_dimensions = {
+    'depth': (0, 12000),
+    'pressure': (0, 12000),
+    'sigma0': (-10, 35),
+    'sigma1': (-5, 40),
+    'sigma2': (0, 45),
+    'sigma3': (5, 50),
+    'sigma4': (10, 55),
+}
+
+_grid_registry = {}
+
+def register_grid_dimension(
+        dimension: str,
+        _min: float,
+        _max: float,
+):
+    """
+    Define the range of the canonical grid for a new independent variable,
+    for use with get_regular_grid().
+    """
+    grid_dimensions[dimension] = (_min, _max)
+    for key in [key for key in _grid_registry if key[1] == dimension]:
+        del _grid_registry[key]
+
+def get_canonical_grid(
+        step: float=1,
+        dimension: str='depth',
+):
+    """
+    Return the canonical grid for step and dimension: a read-only array with
+    every multiple of step within the range of the dimension in
+    grid_dimensions. The grid is built once and shared by all callers.
+    """
+    key = (float(step), dimension)
+    if key not in _grid_registry:
+        if dimension not in grid_dimensions:
+            raise Exception(
+                "Unknown grid dimension {}, use register_grid_dimension()"
+                .format(dimension)
+            )
+        _min, _max = grid_dimensions[dimension]
+        grid = np.array(generate_regular_monotonus_squence(_min, _max, step))
+        grid.setflags(write=False)
+        _grid_registry[key] = (grid, math.ceil(_min/step))
+    return _grid_registry[key][0]
+
+def get_regular_grid(
+        _min: float,
+        _max: float,
+        step: float=1,
+        dimension: str='depth',
+):
+    """
+    Same as generate_regular_monotonus_squence(_min, _max, step), limited
+    to the range of dimension in grid_dimensions, and returned as a
+    read-only view into the canonical grid of step and dimension, without
+    copying. Grid values outside the range are left out, with a warning.
+    Returns a tuple (grid, offset), where offset is the index of the first
+    grid value in the canonical grid.
+
+    Values on grids with the same step and dimension are always identical,
+    so two grids can be aligned by their offsets alone:
+
+    >>> x1, offset1 = get_regular_grid(7.3, 17.234, 1.24)
+    >>> x2, offset2 = get_regular_grid(9.7, 18.75, 1.24)
+    >>> offset1, offset2
+    (6, 8)
+    >>> x1[offset2 - offset1:]
+    array([ 9.92, 11.16, 12.4 , 13.64, 14.88, 16.12])
+    """
+    grid = get_canonical_grid(step, dimension)
+    first = _grid_registry[(float(step), dimension)][1]
+    start = math.ceil(_min/step) - first
+    end = math.floor(_max/step) - first + 1
+    if start < 0 or end > len(grid):
+        logger = logging.getLogger('glodap.util.interp')
+        logger.warning(
+            'Grid from {} to {} clipped to the {} range {} to {}'.format(
+                _min,
+                _max,
+                dimension,
+                *grid_dimensions[dimension],
+            )
+        )
+    start = max(start, 0)
+    end = min(end, len(grid))
+    return grid[start:max(start, end)], start
+
+def grid_overlap(
+        offset1: int,
+        length1: int,
+        offset2: int,
+        length2: int,
+):
+    """
+    Return a tuple of slices selecting the common points of two grids from
+    get_regular_grid(), given their offsets and lengths. Example:
+
+    >>> s1, s2 = grid_overlap(offset1, len(x1), offset2, len(x2))
+    >>> offset = calculate_offset(y1[s1], y2[s2], additive=True)
+    """
+    start = max(offset1, offset2)
+    end = max(min(offset1 + length1, offset2 + length2), start)
+    return (
+        slice(start - offset1, end - offset1),
+        slice(start - offset2, end - offset2),
+    )
+
 def subst_depth_profile_gaps_with_nans (
         x_interp: list=[],
         y_interp: list=[],
@@ -158,6 +338,10 @@ def subst_depth_profile_gaps_with_nans (
 
     y-values for all rows in the gap are set to NaN.
 
+    The profiles can be given in 2-D batches, with one profile per row of
+    y_interp, depths and x_orig (padded with NaNs for shorter profiles).
+    x_interp can be shared by all profiles, or have one row per profile.
+
     Input-variables:
     - x_interp: List of interpolated independent variable, normally depths or
     sigma4
@@ -169,65 +353,324 @@ def subst_depth_profile_gaps_with_nans (
     - thresholds: Ordered dictionary of { depth: gap } values. Means something
     like: For values shallower than key, if gap > value set interpolated values
     to nan
+
+    Returns a tuple (x_interp, y_interp) of numpy arrays, y_interp with
+    NaNs in the gaps.
     """
 
-    prev_index = 0
-    delete_between = []
-    for i, depth in enumerate(depths):
-        if i == 0:
-            continue
-        prev_threshold = 0
-        for threshold, gap in thresholds.items():
-            if prev_threshold <= depth < threshold :
-                if (depth - depths[prev_index]) > gap:
-                    delete_between.append(
-                        {
-                            'min_x': x_orig[prev_index],
-                            'max_x': x_orig[i],
-                        }
+    x_interp = np.asarray(x_interp, dtype=float)
+    y_out = np.array(y_interp, dtype=float)
+    depths = np.atleast_2d(np.asarray(depths, dtype=float))
+    if len(x_orig) == 0:
+        x_orig = depths
+    x_orig = np.atleast_2d(np.asarray(x_orig, dtype=float))
+    y_rows = np.atleast_2d(y_out)
+    x_rows = np.broadcast_to(np.atleast_2d(x_interp), y_rows.shape)
+
+    # Look up the allowed gap for the deeper depth of each pair of samples
+    keys = np.array(sorted(thresholds), dtype=float)
+    max_gaps = np.array([thresholds[key] for key in sorted(thresholds)])
+    depth = depths[:, 1:]
+    ix = np.searchsorted(keys, depth, side='right')
+    with np.errstate(invalid='ignore'):
+        is_gap = (
+            (depth >= 0)
+            & (ix < len(keys))
+            & (
+                (depth - depths[:, :-1])
+                > max_gaps[np.minimum(ix, len(keys) - 1)]
+            )
+        )
+    gap_rows, gap_cols = np.nonzero(is_gap)
+    if len(gap_rows) == 0:
+        return x_interp, y_out
+    gap_start = x_orig[gap_rows, gap_cols]
+    gap_end = x_orig[gap_rows, gap_cols + 1]
+    lower = np.minimum(gap_start, gap_end)
+    upper = np.maximum(gap_start, gap_end)
+
+    # x is in a gap if more gaps start at or before x than end before x
+    query_rows = np.repeat(np.arange(x_rows.shape[0]), x_rows.shape[1])
+    query = x_rows.ravel()
+    in_gap = (
+        _count_in_rows(gap_rows, lower, query_rows, query, inclusive=True)
+        > _count_in_rows(gap_rows, upper, query_rows, query, inclusive=False)
+    )
+    y_rows[in_gap.reshape(y_rows.shape)] = np.nan
+    return x_interp, y_out
+
+def _count_in_rows(values_rows, values, query_rows, query, inclusive):
+    """
+    For each query value, count the values in the same row which are less
+    than (or equal to, if inclusive) the query value. Rows are given as
+    integer row numbers for each element of values and query.
+    """
+    nvalues = len(values)
+    is_query = np.r_[
+        np.zeros(nvalues, dtype=bool),
+        np.ones(len(query), dtype=bool),
+    ]
+    # At equal values, the values are counted first if inclusive
+    ties = is_query if inclusive else ~is_query
+    order = np.lexsort(
+        (ties, np.r_[values, query], np.r_[values_rows, query_rows])
+    )
+    values_before = np.cumsum(~is_query[order])
+    query_order = is_query[order]
+    counts = np.empty(len(query), dtype=int)
+    counts[order[query_order] - nvalues] = values_before[query_order]
+    # Don't count values in previous rows
+    return counts - np.searchsorted(
+        np.sort(values_rows),
+        query_rows,
+        side='left',
+    )
+
+def pchip_interpolate_profiles(
+        data: pd.DataFrame,
+        dimension_key: str,
+        dependent_keys: str or [],
+        x_interp: list,
+        group_keys: list=['EXPOCODE', 'STNNBR', 'CASTNO'],
+        workers: int=1,
+):
+    """
+    Interpolate all profiles in a long-format DataFrame onto the same
+    x_interp in one batch. Profiles are the groups of rows with equal
+    group_keys, e.g. the stations and casts of one or more cruises. For
+    each profile, dependent_keys are interpolated with respect to
+    dimension_key with the same method as pchip_interpolate_profile().
+
+    NaNs are removed and each profile is sorted by dimension_key. Values
+    reported more than once for the same dimension in a profile are
+    averaged. Profiles with less than 2 valid values get NaNs.
+
+    If workers > 1, the profiles are split between that many processes.
+
+    Returns a long-format DataFrame with group_keys, dimension_key and
+    dependent_keys columns, with len(x_interp) rows for each profile.
+
+    Example:
+
+    >>> pchip_interpolate_profiles(data, 'CTDPRS', 'SILCAT', range(0, 6000, 10))
+    """
+    if isinstance(dependent_keys, str):
+        dependent_keys = [ dependent_keys ]
+    x_interp = np.asarray(x_interp, dtype=float)
+
+    groups = data.groupby(group_keys)
+    profile = groups.ngroup().values
+    keys = groups.size().index.to_frame(index=False)
+    in_group = profile >= 0
+    nprofiles = len(keys)
+
+    output = keys.loc[keys.index.repeat(len(x_interp))].reset_index(drop=True)
+    output[dimension_key] = np.tile(x_interp, nprofiles)
+    for key in dependent_keys:
+        y_interp = _pchip_batch(
+            data[dimension_key].values[in_group].astype(float),
+            data[key].values[in_group].astype(float),
+            profile[in_group],
+            nprofiles,
+            x_interp,
+            workers,
+        )
+        output[key] = y_interp.ravel()
+    return output
+
+def pchip_interpolate_ragged(
+        x: list,
+        y: list,
+        x_interp: list,
+        row_sizes: list=None,
+        workers: int=1,
+):
+    """
+    Interpolate a ragged array of profiles onto the same x_interp in one
+    batch, with the same method as pchip_interpolate_profile().
+
+    x and y are either lists of arrays, one for each profile, or flat
+    arrays with the profiles stored one after the other, each profile
+    having the number of elements given in row_sizes.
+
+    Returns an array of interpolated values with one row per profile and
+    one column per x_interp value.
+
+    Example:
+
+    >>> pchip_interpolate_ragged(
+    ...     [[11,13,19,25], [12,18,24]],
+    ...     [[200,350,450,500], [10,20,25]],
+    ...     x_interp=[12, 14, 16],
+    ... )
+    array([[289.76871469, 377.05063821, 414.5480226 ],
+           [ 10.        ,  13.95061728,  17.34567901]])
+    """
+    if row_sizes is None:
+        row_sizes = [len(row) for row in x]
+        x = np.concatenate([np.asarray(row, dtype=float) for row in x])
+        y = np.concatenate([np.asarray(row, dtype=float) for row in y])
+    if len(x) != len(y):
+        raise Exception("x and y must be lists of same size")
+    profile = np.repeat(np.arange(len(row_sizes)), row_sizes)
+    return _pchip_batch(
+        np.asarray(x, dtype=float),
+        np.asarray(y, dtype=float),
+        profile,
+        len(row_sizes),
+        np.asarray(x_interp, dtype=float),
+        workers,
+    )
+
+def _pchip_batch(x, y, profile, nprofiles, x_interp, workers=1):
+    """
+    Run _pchip_kernel() for all profiles, splitting the profiles between
+    worker processes if workers > 1.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            bounds = np.linspace(0, nprofiles, workers + 1).astype(int)
+            futures = []
+            for first, last in zip(bounds[:-1], bounds[1:]):
+                part = (profile >= first) & (profile < last)
+                futures.append(
+                    pool.submit(
+                        _pchip_kernel,
+                        x[part],
+                        y[part],
+                        profile[part] - first,
+                        last - first,
+                        x_interp,
                     )
-            prev_threshold = threshold
-        prev_index = i
-    xout = []
-    yout = []
-    if len(delete_between) == 0:
-        xout = x_interp
-        yout = y_interp
-    else:
-        delete_enumerator = enumerate(delete_between)
-        delete_next = next(delete_enumerator)
-        no_more_gaps = True if len(delete_between) == 0 else False
-        nanset = False
-        for i, xx in enumerate(x_interp):
-            if no_more_gaps:
-                xout.append(xx)
-                yout.append(y_interp[i])
-                continue
-            if xx < delete_next[1]['min_x']:
-                xout.append(xx)
-                yout.append(y_interp[i])
-                continue
-            if delete_next[1]['min_x'] <= xx <= delete_next[1]['max_x']:
-                xout.append(xx)
-                yout.append(np.nan)
-                continue
-            while not no_more_gaps and xx >= delete_next[1]['max_x']:
-                nanset = False
-                try:
-                    delete_next = next(delete_enumerator)
-                    if xx < delete_next[1]['min_x']:
-                        xout.append(xx)
-                        yout.append(y_interp[i])
-                        break
-                    if delete_next[1]['min_x'] <= xx <= delete_next[1]['max_x']:
-                        xout.append(xx)
-                        yout.append(np.nan)
-                        break
-                except Exception as e:
-                    no_more_gaps = True
-                    xout.append(xx)
-                    yout.append(y_interp[i])
-
-
-
-    return xout, yout
+                )
+            return np.concatenate([future.result() for future in futures])
+    return _pchip_kernel(x, y, profile, nprofiles, x_interp)
+
+def _pchip_kernel(x, y, profile, nprofiles, x_interp):
+    """
+    Vectorized PCHIP interpolation of many profiles at once. x, y and
+    profile are flat arrays, profile holding the profile number (0 to
+    nprofiles - 1) of each element. Derivatives are computed as in
+    scipy.interpolate.PchipInterpolator. Returns an array of shape
+    (nprofiles, len(x_interp)), NaN outside the range of each profile.
+    """
+    y_interp = np.full((nprofiles, len(x_interp)), np.nan)
+
+    # Remove nans and sort by profile, then x
+    valid = ~(np.isnan(x) | np.isnan(y))
+    x, y, profile = x[valid], y[valid], profile[valid]
+    order = np.lexsort((x, profile))
+    x, y, profile = x[order], y[order], profile[order]
+
+    # Average duplicate x values within a profile
+    if len(x) > 0:
+        new = np.r_[
+            True,
+            (profile[1:] != profile[:-1]) | (x[1:] != x[:-1])
+        ]
+        unique = np.cumsum(new) - 1
+        y = np.bincount(unique, y) / np.bincount(unique)
+        x, profile = x[new], profile[new]
+
+    # Interpolation not possible for profiles with less than 2 elements
+    counts = np.bincount(profile, minlength=nprofiles)
+    keep = counts[profile] >= 2
+    x, y, profile = x[keep], y[keep], profile[keep]
+    if len(x) == 0:
+        return y_interp
+    counts = counts[profile]
+    first = np.r_[True, profile[1:] != profile[:-1]]
+    last = np.r_[profile[1:] != profile[:-1], True]
+
+    # Interval widths and slopes. Intervals between profiles are garbage,
+    # but never used
+    h = np.diff(x)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = np.diff(y) / h
+    h_prev = np.r_[np.nan, h]
+    h_next = np.r_[h, np.nan]
+    m_prev = np.r_[np.nan, m]
+    m_next = np.r_[m, np.nan]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Interior points: weighted harmonic mean of the slopes, zero at
+        # extrema
+        w1 = 2 * h_next + h_prev
+        w2 = h_next + 2 * h_prev
+        whmean = (w1 / m_prev + w2 / m_next) / (w1 + w2)
+        flat = (
+            (np.sign(m_prev) != np.sign(m_next))
+            | (m_prev == 0)
+            | (m_next == 0)
+        )
+        d = np.where(flat, 0.0, 1.0 / whmean)
+
+        # End points: one-sided three-point estimate
+        h_2nd = np.r_[h[1:], np.nan, np.nan]
+        m_2nd = np.r_[m[1:], np.nan, np.nan]
+        d_first = _pchip_edge_case(h_next, h_2nd, m_next, m_2nd)
+        h_2nd = np.r_[np.nan, np.nan, h[:-1]]
+        m_2nd = np.r_[np.nan, np.nan, m[:-1]]
+        d_last = _pchip_edge_case(h_prev, h_2nd, m_prev, m_2nd)
+    d = np.where(first, d_first, d)
+    d = np.where(last, d_last, d)
+
+    # Profiles of two elements are linear
+    d = np.where(first & (counts == 2), m_next, d)
+    d = np.where(last & (counts == 2), m_prev, d)
+
+    # Find the interval holding each interpolation point, by merging the
+    # sorted data points with the sorted interpolation points
+    nx = len(x_interp)
+    q_profile = np.repeat(np.arange(nprofiles), nx)
+    q_x = np.tile(x_interp, nprofiles)
+    merged_profile = np.r_[profile, q_profile]
+    merged_x = np.r_[x, q_x]
+    is_query = np.r_[
+        np.zeros(len(x), dtype=bool),
+        np.ones(len(q_x), dtype=bool),
+    ]
+    order = np.lexsort((is_query, merged_x, merged_profile))
+    data_before = np.cumsum(~is_query[order])
+    query_position = np.empty(len(q_x), dtype=int)
+    query_position[order[is_query[order]] - len(x)] = np.flatnonzero(
+        is_query[order]
+    )
+    j = data_before[query_position] - 1
+
+    # Inside a profile, and within its range
+    j_safe = np.clip(j, 0, len(x) - 1)
+    inside = (
+        (j >= 0)
+        & (profile[j_safe] == q_profile)
+        & ~(last[j_safe] & (q_x > x[j_safe]))
+    )
+    # The last point of a profile uses the last interval
+    j = np.where(last[j_safe], j_safe - 1, j_safe)[inside]
+    q_x = q_x[inside]
+
+    h = x[j + 1] - x[j]
+    t = (q_x - x[j]) / h
+    t2 = t * t
+    t3 = t2 * t
+    values = (
+        (2 * t3 - 3 * t2 + 1) * y[j]
+        + (t3 - 2 * t2 + t) * h * d[j]
+        + (-2 * t3 + 3 * t2) * y[j + 1]
+        + (t3 - t2) * h * d[j + 1]
+    )
+    y_interp.ravel()[np.flatnonzero(inside)] = values
+    return y_interp
+
+def _pchip_edge_case(h0, h1, m0, m1):
+    """One-sided three-point derivative estimate at the ends of a profile"""
+    d = ((2 * h0 + h1) * m0 - h0 * m1) / (h0 + h1)
+    d = np.where(np.sign(d) != np.sign(m0), 0.0, d)
+    d = np.where(
+        (np.sign(m0) != np.sign(m1)) & (np.abs(d) > 3 * np.abs(m0)),
+        3.0 * m0,
+        d,
+    )
+    return d
@@ -0,0 +1,207 @@
+import logging
+import pandas as pd
+import numpy as np
+from .interp import pchip_interpolate_profiles, get_regular_grid
+
+
+def t90_to_t68(t90):
+    """Convert temperatures from the ITS-90 to the IPTS-68 scale"""
+    return np.asarray(t90, dtype=float) * 1.00024
+
+def t68_to_t90(t68):
+    """Convert temperatures from the IPTS-68 to the ITS-90 scale"""
+    return np.asarray(t68, dtype=float) / 1.00024
+
+def adiabatic_lapse_rate(s, t68, p):
+    """
+    Adiabatic lapse rate of sea water in degC/dbar (UNESCO 1983), for
+    practical salinity s, temperature t68 (IPTS-68) and pressure p (dbar)
+    """
+    s = np.asarray(s, dtype=float)
+    t = np.asarray(t68, dtype=float)
+    p = np.asarray(p, dtype=float)
+    ds = s - 35
+    return (
+        (
+            (
+                ((-2.1687e-16 * t + 1.8676e-14) * t - 4.6206e-13) * p
+                + (2.7759e-12 * t - 1.1351e-10) * ds
+                + ((-5.4481e-14 * t + 8.733e-12) * t - 6.7795e-10) * t
+                + 1.8741e-8
+            ) * p
+        )
+        + (-4.2393e-8 * t + 1.8932e-6) * ds
+        + ((6.6228e-10 * t - 6.836e-8) * t + 8.5258e-6) * t
+        + 3.5803e-5
+    )
+
+def potential_temperature(s, t, p, pr=0, its90: bool=True):
+    """
+    Potential temperature of sea water at reference pressure pr (dbar),
+    for practical salinity s, temperature t and pressure p (dbar), with
+    the Runge-Kutta integration of Fofonoff and Millard (UNESCO 1983).
+    All arguments are broadcast against each other.
+
+    If its90 is True (the default, as for CTDTMP in exchange files), t is
+    on the ITS-90 scale and so is the result. Otherwise both are IPTS-68,
+    as in the UNESCO check value:
+
+    >>> round(float(potential_temperature(40, 40, 10000, its90=False)), 5)
+    36.89073
+    """
+    if its90:
+        t = t90_to_t68(t)
+    t = np.asarray(t, dtype=float)
+    p = np.asarray(p, dtype=float)
+    h = pr - p
+    xk = h * adiabatic_lapse_rate(s, t, p)
+    t = t + 0.5 * xk
+    q = xk
+    p = p + 0.5 * h
+    xk = h * adiabatic_lapse_rate(s, t, p)
+    t = t + 0.29289322 * (xk - q)
+    q = 0.58578644 * xk + 0.121320344 * q
+    xk = h * adiabatic_lapse_rate(s, t, p)
+    t = t + 1.707106781 * (xk - q)
+    q = 3.414213562 * xk - 4.121320344 * q
+    p = p + 0.5 * h
+    xk = h * adiabatic_lapse_rate(s, t, p)
+    theta = t + (xk - 2 * q) / 6
+    if its90:
+        theta = t68_to_t90(theta)
+    return theta
+
+def density(s, t, p, its90: bool=True):
+    """
+    In situ density of sea water in kg/m3, with the EOS-80 equation of
+    state and its secant bulk modulus (UNESCO 1983), for practical salinity
+    s, temperature t and pressure p (dbar). See potential_temperature()
+    for its90. Check values:
+
+    >>> round(float(density(35, 5, 0, its90=False)), 5)
+    1027.67547
+    >>> round(float(density(35, 25, 10000, its90=False)), 5)
+    1062.53817
+    """
+    if its90:
+        t = t90_to_t68(t)
+    s = np.asarray(s, dtype=float)
+    t = np.asarray(t, dtype=float)
+    p = np.asarray(p, dtype=float) / 10 # bar
+    s15 = s * np.sqrt(s)
+
+    rho_w = (
+        ((((6.536332e-9 * t - 1.120083e-6) * t + 1.001685e-4) * t
+        - 9.095290e-3) * t + 6.793952e-2) * t + 999.842594
+    )
+    rho_0 = (
+        rho_w
+        + s * ((((5.3875e-9 * t - 8.2467e-7) * t + 7.6438e-5) * t
+            - 4.0899e-3) * t + 0.824493)
+        + s15 * ((-1.6546e-6 * t + 1.0227e-4) * t - 5.72466e-3)
+        + 4.8314e-4 * s * s
+    )
+
+    k_w = (
+        (((-5.155288e-5 * t + 1.360477e-2) * t - 2.327105) * t + 148.4206)
+        * t + 19652.21
+    )
+    k_0 = (
+        k_w
+        + s * (((-6.1670e-5 * t + 1.09987e-2) * t - 0.603459) * t + 54.6746)
+        + s15 * ((-5.3009e-4 * t + 1.6483e-2) * t + 7.944e-2)
+    )
+    a = (
+        ((-5.77905e-7 * t + 1.16092e-4) * t + 1.43713e-3) * t + 3.239908
+        + s * ((-1.6078e-6 * t - 1.0981e-5) * t + 2.2838e-3)
+        + 1.91075e-4 * s15
+    )
+    b = (
+        (5.2787e-8 * t - 6.12293e-6) * t + 8.50935e-5
+        + s * ((9.1697e-10 * t + 2.0816e-8) * t - 9.9348e-7)
+    )
+    k = k_0 + (a + b * p) * p
+    return rho_0 / (1 - p / k)
+
+def potential_density_anomaly(s, t, p, pr=0, its90: bool=True):
+    """
+    Potential density anomaly (potential density - 1000 kg/m3) at reference
+    pressure pr (dbar), e.g. sigma4 for pr=4000. See potential_temperature()
+    for the arguments.
+    """
+    theta = potential_temperature(s, t, p, pr, its90)
+    return density(s, theta, pr, its90) - 1000
+
+def add_potential_density(
+        data: pd.DataFrame,
+        reference_pressures: list=[0, 1000, 2000, 3000, 4000],
+        salinity_key: str='CTDSAL',
+        temperature_key: str='CTDTMP',
+        pressure_key: str='CTDPRS',
+):
+    """
+    Add potential temperature and potential density anomaly columns to an
+    exchange DataFrame, e.g. from excread(), computed for all rows at once:
+
+    - EXC_THETA: potential temperature at 0 dbar (ITS-90)
+    - EXC_SIGMA0 ... EXC_SIGMA4: potential density anomaly at each of
+      reference_pressures, named by thousands of dbar
+
+    Rows missing any of the input values get NaNs. Returns the DataFrame.
+    """
+    s = data[salinity_key].values.astype(float)
+    t = data[temperature_key].values.astype(float)
+    p = data[pressure_key].values.astype(float)
+    data['EXC_THETA'] = potential_temperature(s, t, p)
+    for pr in reference_pressures:
+        data['EXC_SIGMA{}'.format(int(pr // 1000))] = (
+            potential_density_anomaly(s, t, p, pr)
+        )
+    return data
+
+def interpolate_on_density(
+        data: pd.DataFrame,
+        dependent_keys: str or list,
+        reference_pressure: float=4000,
+        step: float=0.01,
+        sigma_interp: list=None,
+        group_keys: list=['EXPOCODE', 'STNNBR', 'CASTNO'],
+        workers: int=1,
+        **keys
+):
+    """
+    Interpolate whole cruises onto a potential density grid. The potential
+    density anomaly at reference_pressure is computed for all rows with
+    add_potential_density() (keys are passed on, e.g. salinity_key), and
+    each profile of dependent_keys is interpolated with respect to it with
+    pchip_interpolate_profiles().
+
+    The grid defaults to the canonical grid with step over the range of
+    the data, for the grid dimension of the reference pressure (e.g.
+    sigma4).
+
+    Returns a long-format DataFrame as pchip_interpolate_profiles(), with
+    the density column named e.g. EXC_SIGMA4.
+    """
+    logger = logging.getLogger('glodap.util.seawater')
+    sigma = 'sigma{}'.format(int(reference_pressure // 1000))
+    sigma_key = 'EXC_' + sigma.upper()
+    data = add_potential_density(data.copy(), [reference_pressure], **keys)
+    if sigma_interp is None:
+        sigma_interp, _ = get_regular_grid(
+            data[sigma_key].min(),
+            data[sigma_key].max(),
+            step,
+            sigma,
+        )
+    logger.info(
+        'Interpolating on {} {} values'.format(len(sigma_interp), sigma_key)
+    )
+    return pchip_interpolate_profiles(
+        data,
+        sigma_key,
+        dependent_keys,
+        sigma_interp,
+        group_keys,
+        workers,
+    )
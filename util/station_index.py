@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from .geo import _earth_radius
+
+
+class StationIndex():
+    """
+    Spatial index of station positions, for finding crossover stations.
+    Positions are stored as 3-D unit vectors in a KD-tree, so radius and
+    nearest neighbour queries take roughly logarithmic time, and work
+    across the date line and near the poles. Distances are great circle
+    distances in meters, the same as geo.haversine_distance(). Usage:
+
+    >>> index = StationIndex.from_dataframe(reference_data)
+    >>> index.save('glodap_stations.npz')
+    >>> index = StationIndex.load('glodap_stations.npz')
+    >>> i, j, distance = index.stations_within_distance(
+    ...     cruise['LONGITUDE'], cruise['LATITUDE'], 100000)
+    >>> index.stations.iloc[j]
+
+    stations is a DataFrame with one row per indexed position, holding
+    the station identifiers (e.g. EXPOCODE, STNNBR, CASTNO) if given.
+    """
+    def __init__(self, lon, lat, stations: pd.DataFrame=None):
+        self.lon = np.asarray(lon, dtype=float)
+        self.lat = np.asarray(lat, dtype=float)
+        if stations is None:
+            stations = pd.DataFrame(index=range(len(self.lon)))
+        self.stations = stations.reset_index(drop=True)
+        self._tree = cKDTree(_unit_vectors(self.lon, self.lat))
+
+    @classmethod
+    def from_dataframe(
+            cls,
+            data: pd.DataFrame,
+            station_keys: list=['EXPOCODE', 'STNNBR', 'CASTNO'],
+            lon_key: str='LONGITUDE',
+            lat_key: str='LATITUDE',
+    ):
+        """
+        Build an index of the stations in an exchange DataFrame, with one
+        position per unique combination of station_keys.
+        """
+        stations = data.groupby(station_keys)[[lon_key, lat_key]].first()
+        stations = stations.dropna().reset_index()
+        return cls(
+            stations[lon_key].values,
+            stations[lat_key].values,
+            stations[station_keys],
+        )
+
+    def __len__(self):
+        return len(self.lon)
+
+    def query_radius(self, lon, lat, max_distance):
+        """
+        Return a list with an array of station indices within max_distance
+        meters, for each point in (lon, lat).
+        """
+        return [
+            np.array(sorted(indices), dtype=int)
+            for indices in self._tree.query_ball_point(
+                _unit_vectors(lon, lat),
+                _chord(max_distance),
+            )
+        ]
+
+    def query_nearest(self, lon, lat, k: int=1):
+        """
+        Return a tuple (distance, index) of arrays with shape (len(lon), k),
+        holding the distances in meters to, and indices of, the k nearest
+        stations for each point in (lon, lat).
+        """
+        chord, index = self._tree.query(_unit_vectors(lon, lat), k=k)
+        if k == 1:
+            chord = chord[:, np.newaxis]
+            index = index[:, np.newaxis]
+        return _arc(chord), index
+
+    def stations_within_distance(self, lon, lat, max_distance):
+        """
+        Find all pairs of points in (lon, lat) and indexed stations within
+        max_distance meters of each other. Returns a tuple (index_1,
+        index_2, distance) of arrays, like geo.stations_within_distance().
+        """
+        matches = self.query_radius(lon, lat, max_distance)
+        index_1 = np.repeat(
+            np.arange(len(matches)),
+            [len(indices) for indices in matches],
+        )
+        if len(index_1) == 0:
+            return index_1, index_1.copy(), np.array([], dtype=float)
+        index_2 = np.concatenate(matches)
+        points = _unit_vectors(lon, lat)[index_1]
+        chord = np.linalg.norm(points - self._tree.data[index_2], axis=1)
+        return index_1, index_2, _arc(chord)
+
+    def save(self, path):
+        """Save the index to a numpy .npz file"""
+        columns = {}
+        for ix, name in enumerate(self.stations.columns):
+            values = self.stations[name].values
+            if values.dtype == object:
+                values = values.astype(str)
+            columns['station_{}'.format(ix)] = values
+        np.savez(
+            path,
+            lon=self.lon,
+            lat=self.lat,
+            station_columns=np.array(self.stations.columns, dtype=str),
+            **columns
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved with save()"""
+        with np.load(path) as saved:
+            stations = pd.DataFrame({
+                name: saved['station_{}'.format(ix)]
+                for ix, name in enumerate(saved['station_columns'])
+            }, columns=list(saved['station_columns']))
+            return cls(saved['lon'], saved['lat'], stations)
+
+
+def _unit_vectors(lon, lat):
+    """Return an (n, 3) array of unit vectors for positions in degrees"""
+    lon = np.radians(np.atleast_1d(np.asarray(lon, dtype=float)))
+    lat = np.radians(np.atleast_1d(np.asarray(lat, dtype=float)))
+    cos_lat = np.cos(lat)
+    return np.column_stack(
+        (cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat))
+    )
+
+def _chord(distance):
+    """Chord length on the unit sphere for a great circle distance in m"""
+    angle = np.minimum(np.asarray(distance) / (_earth_radius * 1000), np.pi)
+    return 2 * np.sin(angle / 2)
+
+def _arc(chord):
+    """Great circle distance in m for a chord length on the unit sphere"""
+    return 2 * np.arcsin(np.minimum(chord / 2, 1)) * _earth_radius * 1000
@@ -6,26 +6,71 @@ from operator import itemgetter
 def _get_matching_dimensions_for_station(
         data1: pd.DataFrame,
         data2: pd.DataFrame,
-        dimension_key: str
+        dimension_key: str,
+        tolerance: float = None,
 ):
     """
-    Return DataFrames with only the matching values
+    Return DataFrames with only the matching values. The rows of the two
+    DataFrames are aligned, ordered by dimension_key. See
+    _get_matching_indices() for tolerance.
     """
 
-    output1 = data1[data1[dimension_key].isin(data2[dimension_key])]
-    output2 = data2[data2[dimension_key].isin(data1[dimension_key])]
+    index_1, index_2 = _get_matching_indices(
+        data1[dimension_key].values,
+        data2[dimension_key].values,
+        tolerance,
+    )
+    output1 = data1.iloc[index_1].copy()
+    output2 = data2.iloc[index_2].copy()
     return output1, output2
 
-def _get_matching_indices(x1: list=[], x2: list=[]):
+def _get_matching_indices(x1: list=[], x2: list=[], tolerance: float=None):
     """
-    Return matching indices
+    Return matching indices, as a tuple of integer arrays (index_1, index_2)
+    where x1[index_1[i]] matches x2[index_2[i]], ordered by value. Each
+    element is matched at most once, duplicates use their first occurrence.
+
+    Without tolerance, values must be equal. With tolerance, values within
+    tolerance of each other match, which allows matching grid values with
+    rounding errors. Both arrays are sorted and merged in one pass, pairing
+    the smallest unmatched values first, so a value that can not take its
+    nearest neighbour is still matched with the next one:
+
+    >>> _get_matching_indices([1.0, 1.05], [1.04, 1.1], tolerance=0.1)
+    (array([0, 1]), array([0, 1]))
+
+    Runs in n log n time.
     """
-    x = set(x1) & set(x2)
-    index_1 = [x1.index(_x) for _x in x]
-    index_2 = [x2.index(_x) for _x in x]
-    index_1.sort()
-    index_2.sort()
-    return index_1, index_2
+    x1 = np.asarray(x1, dtype=float)
+    x2 = np.asarray(x2, dtype=float)
+    if not tolerance:
+        _, index_1, index_2 = np.intersect1d(x1, x2, return_indices=True)
+        return index_1, index_2
+
+    order_1 = np.flatnonzero(~np.isnan(x1))
+    order_1 = order_1[np.argsort(x1[order_1], kind='mergesort')]
+    order_2 = np.flatnonzero(~np.isnan(x2))
+    order_2 = order_2[np.argsort(x2[order_2], kind='mergesort')]
+    sorted_1 = x1[order_1].tolist()
+    sorted_2 = x2[order_2].tolist()
+
+    matches_1 = []
+    matches_2 = []
+    i = j = 0
+    while i < len(sorted_1) and j < len(sorted_2):
+        if abs(sorted_1[i] - sorted_2[j]) <= tolerance:
+            matches_1.append(i)
+            matches_2.append(j)
+            i += 1
+            j += 1
+        elif sorted_1[i] < sorted_2[j]:
+            i += 1
+        else:
+            j += 1
+    return (
+        order_1[np.array(matches_1, dtype=int)],
+        order_2[np.array(matches_2, dtype=int)],
+    )
 
 def calculate_offset(
         array1: list,
@@ -51,9 +96,11 @@ def stats_and_offset(
         dimension_key: str,
         dependent_key: str,
         use_additive_offset: bool = False,
+        tolerance: float = None,
 ):
     """
-    Calculate stats for variables in two stations. Returns a
+    Calculate stats for variables in two stations, on the dimension values
+    found in both (within tolerance, if given). Returns a
     pandas.DataFrame with the following columns:
 
     columns = ['dimension', 'station1', 'station1_mean', 'station1_stdev',
@@ -64,6 +111,7 @@ def stats_and_offset(
         input,
         reference,
         dimension_key,
+        tolerance,
     )
     if len(input) < 2:
         return input
@@ -78,6 +126,105 @@ def stats_and_offset(
 
     return input
 
+def stats_and_offset_batch(
+        input: pd.DataFrame,
+        reference: pd.DataFrame,
+        pairs: pd.DataFrame or list,
+        dimension_key: str,
+        dependent_keys: str or list,
+        station_keys: str or list = ['EXPOCODE', 'STNNBR', 'CASTNO'],
+        use_additive_offset: bool = False,
+        min_count: int = 2,
+):
+    """
+    Calculate stats and offsets for many pairs of stations and parameters
+    at once. input and reference are long-format DataFrames holding the
+    profiles of many stations on a shared grid (e.g. from
+    pchip_interpolate_profiles()), identified by the values of
+    station_keys. pairs holds (input station, reference station) pairs,
+    either as a DataFrame with station_keys columns for the input station
+    and 'REF_' + key columns for the reference station (as returned by
+    crossover.crossover_analysis()), or as a list of tuples of the
+    station_keys values of both stations, e.g.
+    [(('33RR20160208', 1, 1), ('06AQ20110405', 7, 2))].
+
+    Each pair is matched on equal dimension_key values, as in
+    stats_and_offset(). Pairs with less than min_count matching values for
+    a parameter are left out. Returns a tidy pandas.DataFrame with one row
+    per pair and parameter, and the following columns:
+
+    columns = [*station_keys, *['REF_' + key for key in station_keys],
+    'parameter', 'count', 'station1_mean', 'station1_stdev',
+    'station2_mean', 'station2_stdev', 'offset_mean', 'offset_stdev',
+    ]
+    """
+    if isinstance(dependent_keys, str):
+        dependent_keys = [ dependent_keys ]
+    if isinstance(station_keys, str):
+        station_keys = [ station_keys ]
+    ref_keys = ['REF_' + key for key in station_keys]
+    pair_keys = station_keys + ref_keys
+    if not isinstance(pairs, pd.DataFrame):
+        pairs = pd.DataFrame(
+            [
+                (*_station_tuple(station1), *_station_tuple(station2))
+                for station1, station2 in pairs
+            ],
+            columns=pair_keys,
+        )
+    columns = station_keys + [dimension_key] + dependent_keys
+
+    matched = pairs[pair_keys].drop_duplicates().merge(
+        input[columns],
+        on=station_keys,
+    ).merge(
+        reference[columns].rename(columns=dict(zip(station_keys, ref_keys))),
+        on=ref_keys + [dimension_key],
+        suffixes=('_1', '_2'),
+    )
+
+    parameters = []
+    for key in dependent_keys:
+        values1 = matched[key + '_1'].values.astype(float)
+        values2 = matched[key + '_2'].values.astype(float)
+        valid = ~(np.isnan(values1) | np.isnan(values2))
+        values1, values2 = values1[valid], values2[valid]
+        if use_additive_offset:
+            offset = values1 - values2
+        else: # multiplicative
+            with np.errstate(divide='ignore', invalid='ignore'):
+                offset = values1 / values2
+        parameter = matched.loc[valid, pair_keys].reset_index(drop=True)
+        parameter['parameter'] = key
+        parameter['station1_value'] = values1
+        parameter['station2_value'] = values2
+        parameter['offset'] = offset
+        parameters.append(parameter)
+    stats_columns = [
+        'count', 'station1_mean', 'station1_stdev', 'station2_mean',
+        'station2_stdev', 'offset_mean', 'offset_stdev',
+    ]
+    if not parameters:
+        return pd.DataFrame(columns=pair_keys + ['parameter'] + stats_columns)
+
+    output = pd.concat(parameters, ignore_index=True).groupby(
+        pair_keys + ['parameter'],
+        sort=False,
+    ).agg({
+        'station1_value': ['count', 'mean', 'std'],
+        'station2_value': ['mean', 'std'],
+        'offset': ['mean', 'std'],
+    })
+    output.columns = stats_columns
+    output = output.reset_index()
+    return output[output['count'] >= min_count].reset_index(drop=True)
+
+def _station_tuple(station):
+    """Return the station_keys values of a station as a tuple"""
+    if isinstance(station, (tuple, list)):
+        return tuple(station)
+    return (station,)
+
 def linear_fit(x, y):
     """
     Calculates linear regression for x and y. First removing all elemets